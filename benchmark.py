@@ -0,0 +1,256 @@
+#!/usr/local/bin/python
+# coding=utf-8
+"""
+Benchmarks for pokedex lookups, tracker load and save, and battles.
+
+Synthetic trackers are generated for each size with a fixed random seed, so
+runs are comparable. Results are written as JSON with --output, and
+--compare reports every benchmark that got slower than a saved baseline by
+more than --threshold, exiting with status 1 if any did.
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import config
+import history
+import pokedex
+import tracker
+from config import Config
+from pokemon import ITEMS, EvSet, configure_modifiers
+
+DEFAULT_SIZES = (100, 10000, 1000000)
+
+_SEED = 20240101
+_TEAM_SIZE = 6
+
+
+def _load_ev_tracker():
+    """Import ev-tracker.py, which can not be imported by name."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ev-tracker.py')
+    spec = importlib.util.spec_from_file_location('ev_tracker', path)
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+
+def _random_evs(rng: random.Random, total_max=510, stat_max=252) -> dict:
+    evs = dict.fromkeys(EvSet.STATS, 0)
+    remaining = rng.randint(0, total_max)
+    for stat in rng.sample(EvSet.STATS, len(EvSet.STATS)):
+        amount = rng.randint(0, min(stat_max, remaining))
+        evs[stat] = amount
+        remaining -= amount
+    return evs
+
+
+def _random_targets(rng: random.Random) -> dict:
+    targets = dict.fromkeys(EvSet.STATS, 0)
+    first, second, third = rng.sample(EvSet.STATS, 3)
+    targets[first] = targets[second] = 252
+    targets[third] = 4
+    return targets
+
+
+def _records(size, seed=_SEED):
+    """
+    Yield size synthetic Pokemon records. About one in ten is a form of a
+    species with several forms, three in ten hold an item, four in ten have
+    targets and one in ten has Pokerus.
+    """
+    rng = random.Random(seed)
+    species_list = pokedex.all_species()
+    plain = [species for species in species_list if not species.form]
+    forms = [species for species in species_list if species.form]
+    items = list(ITEMS)
+    for individual_id in range(1, size + 1):
+        if forms and rng.random() < 0.1:
+            species = rng.choice(forms)
+            record = {'species': species.name, 'form': species.form}
+        else:
+            record = {'species': rng.choice(plain).id}
+        record.update({
+            'name': 'Mon%d' % individual_id if rng.random() < 0.2 else None,
+            'pokerus': rng.random() < 0.1,
+            'item': rng.choice(items) if rng.random() < 0.3 else None,
+            'evs': _random_evs(rng),
+            'id': individual_id,
+            'target_evs': _random_targets(rng) if rng.random() < 0.4 else dict.fromkeys(EvSet.STATS, 0),
+        })
+        yield record
+
+
+def write_tracker(filename, size, seed=_SEED):
+    """Write a synthetic tracker file of size Pokemon, with a full team."""
+    team = list(range(1, min(size, _TEAM_SIZE) + 1))
+    archive = list(range(_TEAM_SIZE + 1, size + 1, 10))
+    with open(filename, 'w') as fp:
+        tracker._write_tracker_file(fp, team, archive, _records(size, seed))
+
+
+def _measure(function, repeat, number=1, setup=None) -> dict:
+    """Time function, number calls per run, returning seconds per call."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {'seconds': min(times), 'median': statistics.median(times), 'runs': repeat, 'number': number}
+
+
+def _fuzzy_miss():
+    try:
+        pokedex.search('pikachuu')
+    except pokedex.NoSuchSpecies:
+        pass
+
+
+def bench_pokedex(results, repeat):
+    pokedex.search('pikachu')
+    results['pokedex.search.exact'] = _measure(lambda: pokedex.search('pikachu'), repeat, 1000)
+    results['pokedex.search.id'] = _measure(lambda: pokedex.search('25'), repeat, 1000)
+    results['pokedex.search.fuzzy_miss'] = _measure(_fuzzy_miss, repeat, 100)
+
+
+def bench_evset(results, repeat):
+    limits = EvSet.effort_limits()
+    modifier = EvSet(speed=3, attack=2)
+    evs = EvSet(hp=100, speed=200)
+    results['EvSet.capped_add'] = _measure(lambda: evs.capped_add(modifier, limits), repeat, 10000)
+
+
+def bench_tracker(results, ev_tracker, directory, size, repeat):
+    filename = os.path.join(directory, 'tracker-%d.json' % size)
+    write_tracker(filename, size)
+    # Larger trackers take seconds per run, so run them fewer times.
+    repeat = max(1, repeat if size <= 10000 else repeat // 3)
+    loaded = {}
+
+    def load():
+        loaded['tracker'] = tracker.Tracker.from_json(filename)
+        loaded['tracker'].get_team()
+
+    def build_all():
+        loaded['tracker'].pokemon.build_all()
+
+    results['Tracker.from_json[%d]' % size] = _measure(load, repeat)
+    results['Tracker.build_all[%d]' % size] = _measure(build_all, repeat, setup=load)
+
+    load()
+    output = os.path.join(directory, 'output-%d.json' % size)
+    results['Tracker.to_json[%d]' % size] = _measure(lambda: loaded['tracker'].to_json(output), repeat)
+
+    # Stand in for the session the prompt would have loaded.
+    config.instance.filename = filename
+    ev_tracker._session.config = config.instance
+    ev_tracker._tracker = tracker.Tracker.from_json(filename)
+    ev_tracker._history = history.History(filename)
+    team = list(ev_tracker._tracker.get_team())
+
+    def save():
+        ev_tracker._tracker.mark_changed(ev_tracker._tracker.get_pokemon(team[0]))
+        ev_tracker._save_tracker()
+
+    results['_save_tracker[%d]' % size] = _measure(save, repeat)
+
+    args = argparse.Namespace(species='pikachu', id=None, count=1)
+
+    def battle():
+        with contextlib.redirect_stdout(io.StringIO()):
+            ev_tracker._cmd_battle(args)
+
+    results['_cmd_battle.team[%d]' % size] = _measure(battle, repeat)
+    for leftover in (filename, output, filename + history.History.SUFFIX):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def run(sizes, repeat) -> dict:
+    ev_tracker = _load_ev_tracker()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        config_instance = Config()
+        config.instance = config_instance
+        configure_modifiers(config_instance)
+        bench_pokedex(results, repeat)
+        bench_evset(results, repeat)
+        for size in sizes:
+            bench_tracker(results, ev_tracker, directory, size, repeat)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'sizes': list(sizes),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold) -> list[str]:
+    """Print each benchmark against the baseline and return the names of the regressions."""
+    regressions = []
+    print('%-32s %12s %12s %8s' % ('Benchmark', 'baseline ms', 'current ms', 'change'))
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['seconds']
+        after = result['seconds']
+        change = after / before - 1 if before > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-32s %12.4f %12.4f %+7.1f%%%s' % (name, before * 1000, after * 1000, change * 100, flag))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the tracker on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='Numbers of tracked Pokemon to benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each benchmark, the fastest is kept')
+    parser.add_argument('--output', '-o', help='Write the results to this JSON file')
+    parser.add_argument('--compare', '-c', metavar='BASELINE', help='Compare against results saved with --output')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown counted as a regression, as a fraction (default 0.2)')
+    options = parser.parse_args(argv)
+
+    report = run(options.sizes, options.repeat)
+    if options.output is not None:
+        with open(options.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if options.compare is None:
+        if options.output is None:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        return 0
+    with open(options.compare, 'r') as fp:
+        baseline = json.load(fp)
+    regressions = compare(report, baseline, options.threshold)
+    if regressions:
+        print('%d benchmarks regressed by more than %d%%' % (len(regressions), options.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,6 +11,12 @@ class Config(object):
         self.filename = None
         self.generation = 9
         self.is_bdsp = False
+        self.storage = 'snapshot'
+        self.journal_threshold = 100
+        self.eager_pokedex = False
+        self.species_cache_size = 1024
+        self.metrics_file = None
+        self.fsync = 'full'
 
     def double_power_items_effort(self):
         return self.generation > 6 and not self.is_bdsp
@@ -24,6 +30,12 @@ class Config(object):
     def ignore_pokerus(self):
         return self.generation == 9
 
+    def uses_journal(self):
+        return self.storage == 'journal'
+
+    def uses_sqlite(self):
+        return self.storage == 'sqlite'
+
     @classmethod
     def from_json(cls, filename):
         config = cls()
@@ -40,6 +52,18 @@ class Config(object):
                 config.generation = data['generation']
             if 'is_bdsp' in data:
                 config.is_bdsp = data['is_bdsp']
+            if 'storage' in data:
+                config.storage = data['storage']
+            if 'journal_threshold' in data:
+                config.journal_threshold = data['journal_threshold']
+            if 'eager_pokedex' in data:
+                config.eager_pokedex = data['eager_pokedex']
+            if 'species_cache_size' in data:
+                config.species_cache_size = data['species_cache_size']
+            if 'metrics_file' in data:
+                config.metrics_file = data['metrics_file']
+            if 'fsync' in data:
+                config.fsync = data['fsync']
         except IOError:
             if filename is None:
                 config.filename = DEFAULT_TRACKER_PATH
@@ -55,6 +79,12 @@ class Config(object):
             'filename': config.filename,
             'generation': config.generation,
             'is_bdsp': config.is_bdsp,
+            'storage': config.storage,
+            'journal_threshold': config.journal_threshold,
+            'eager_pokedex': config.eager_pokedex,
+            'species_cache_size': config.species_cache_size,
+            'metrics_file': config.metrics_file,
+            'fsync': config.fsync,
         }
 
         json.dump(data, fp)
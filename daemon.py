@@ -0,0 +1,205 @@
+#!/usr/local/bin/python
+# coding=utf-8
+"""
+A tracker daemon serving many clients from one in-memory tracker.
+
+The daemon listens on a Unix domain socket and runs the same subcommands as
+the prompt, one at a time, against a tracker and pokedex caches it keeps
+loaded. Changes are written to disk every --flush-interval seconds instead of
+after every command, and when the daemon stops.
+
+    python daemon.py --serve &
+    python daemon.py track pikachu
+    python daemon.py battle 16 -c 3
+
+Each request is one line of JSON, {"argv": [...]}, answered by one line,
+{"ok": true, "output": "..."}. A connection may send any number of requests.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import signal
+import socket
+import sys
+
+DEFAULT_SOCKET = os.path.expanduser(os.path.join('~', '.ev-tracker.sock'))
+DEFAULT_FLUSH_INTERVAL = 2.0
+
+
+def _load_ev_tracker():
+    """Import ev-tracker.py, which can not be imported by name."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ev-tracker.py')
+    spec = importlib.util.spec_from_file_location('ev_tracker', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Server(object):
+    """
+    Runs client commands against the tracker of one ev-tracker session.
+    Commands run on the event loop one after another, so they never see
+    each other's partial changes.
+    """
+
+    def __init__(self, ev_tracker, filename=None, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.ev = ev_tracker
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.parser = ev_tracker._build_parser()
+        # Commands save through the batch, which the timer flushes. A failed
+        # command only rolls back its own changes, keeping the unsaved
+        # changes of the commands before it.
+        ev_tracker._batch = ev_tracker._Batch(rollback=False)
+
+    def flush(self):
+        """Write the changes made since the last flush."""
+        batch = self.ev._batch
+        if not batch.dirty:
+            return
+        batch.dirty = False
+        try:
+            self.ev._write_tracker()
+        except self.ev.TrackerConflict as e:
+            self.ev._session.invalidate()
+            print('%s, the unsaved changes were discarded' % e, file=sys.stderr)
+
+    def run(self, argv) -> tuple[bool, str]:
+        """Run one subcommand, returning whether it succeeded and what it printed."""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                args = self.parser.parse_args(argv)
+            except argparse.ArgumentError as e:
+                print(e)
+                return False, output.getvalue()
+            except SystemExit as e:
+                return e.code in (0, None), output.getvalue()
+            if args.filename is None:
+                args.filename = self.filename
+            if self.ev._batch.dirty and self.ev._session.would_reload(args.filename):
+                # Loading the tracker again would drop the unsaved changes.
+                self.flush()
+            try:
+                succeeded = self.ev.execute_command(args)
+            except Exception as e:
+                print(f"Error: {e}")
+                succeeded = False
+        return succeeded, output.getvalue()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    argv = json.loads(line)['argv']
+                except (ValueError, KeyError, TypeError):
+                    response = {'ok': False, 'output': 'Invalid request\n'}
+                else:
+                    succeeded, output = self.run(argv)
+                    response = {'ok': succeeded, 'output': output}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    async def serve(self, path):
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, stop.set)
+        flusher = asyncio.create_task(self.flush_periodically())
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            flusher.cancel()
+            self.flush()
+            self.ev._session.close()
+
+
+def _remove_stale_socket(path) -> bool:
+    """Remove a socket left behind by a daemon that is gone. Returns False if one is still listening."""
+    if not os.path.exists(path):
+        return True
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+            return False
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+    os.remove(path)
+    return True
+
+
+def serve(path, filename=None, flush_interval=DEFAULT_FLUSH_INTERVAL) -> int:
+    if not _remove_stale_socket(path):
+        print('A daemon is already listening on %s' % path, file=sys.stderr)
+        return 1
+    server = Server(_load_ev_tracker(), filename, flush_interval)
+    try:
+        asyncio.run(server.serve(path))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return 0
+
+
+def request(path, argv) -> int:
+    """Send one subcommand to the daemon and print its output."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            print('No daemon is listening on %s, start one with --serve' % path, file=sys.stderr)
+            return 2
+        client.sendall(json.dumps({'argv': argv}).encode() + b'\n')
+        response = json.loads(client.makefile('rb').readline())
+    sys.stdout.write(response['output'])
+    return 0 if response['ok'] else 1
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Run the tracker daemon with --serve, or send it a command.',
+        usage='%(prog)s [--socket PATH] (--serve [--infile FILE] [--flush-interval SECONDS] | command ...)',
+    )
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Path of the Unix domain socket')
+    parser.add_argument('--serve', action='store_true', default=False, help='Run the daemon')
+    parser.add_argument('--infile', '-i', dest='filename', help='Tracker file for commands that do not give one')
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help='Seconds between writes of the changed tracker (default %(default)s)')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Subcommand to send to the daemon')
+    options = parser.parse_args(argv)
+    if options.serve:
+        if options.command:
+            parser.error('--serve takes no command')
+        if options.flush_interval <= 0:
+            parser.error('--flush-interval must be positive')
+        return serve(options.socket, options.filename, options.flush_interval)
+    if not options.command:
+        parser.error('give a command, or --serve to run the daemon')
+    command = options.command
+    if options.filename is not None:
+        # The daemon resolves paths from its own working directory.
+        command = ['--infile', os.path.abspath(options.filename)] + command
+    return request(options.socket, command)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,9 +3,15 @@
 
 
 import argparse
+import contextlib
+import csv
+import datetime
 import json
 import os
+import re
 import shlex
+import sys
+import time
 try:
     import readline
 except ModuleNotFoundError as _:
@@ -18,135 +24,217 @@ except ModuleNotFoundError as _:
 from shutil import copyfile
 
 import config
+import history
+import planner
 import pokedex
+import query
+import timings
 from config import Config
-from pokemon import Pokemon
+from pokemon import EvSet, Pokemon, configure_modifiers
+from tracker import Journal, NoActivePokemon, NoTrackedPokemon, SqliteStore, Tracker, TrackerConflict
 
 
-class Tracker(object):
-
-    @classmethod
-    def from_json(cls, filename):
-        tracker = cls()
-        tracker.filename = filename
-        try:
-            fp = open(filename, 'r')
-            data = json.load(fp)
-            for spec in data['pokemon']:
-                pokemon = Pokemon.from_dict(spec)
-                tracker.track(pokemon)
-            if 'team' in data:
-                tracker._team = set(data['team'])
-            if 'archive' in data:
-                tracker._archive = set(data['archive'])
-        except IOError:
-            pass  # Ignore missing tracking file.
-
-        return tracker
-
-    def to_json(self, filename=None):
-        filename = self.filename if filename is None else filename
-        fp = open(filename, 'w')
-        data = {
-            'team': sorted(self._team),
-            'archive': sorted(self._archive),
-            'pokemon': [pokemon.to_dict() for pokemon in self.pokemon.values()],
-        }
-
-        json.dump(data, fp)
-        fp.close()
-
-    pokemon = {}
-
-    def __init__(self):
-        self._team = set()
-        self._archive = set()
-        self.counter = 1
-        self.filename = None
-
-    def add_to_team(self, individual_id):
-        self._team.add(individual_id)
-
-    def on_team(self, individual_id):
-        return individual_id in self._team
-
-    def remove_from_team(self, individual_id):
-        if self.on_team(individual_id):
-            self._team.remove(individual_id)
-
-    def get_team(self):
-        return self._team
-
-    def add_to_archive(self, individual_id):
-        self._archive.add(individual_id)
-
-    def in_archive(self, individual_id):
-        return individual_id in self._archive
-
-    def remove_from_archive(self, individual_id):
-        if self.in_archive(individual_id):
-            self._archive.remove(individual_id)
-
-    def get_archive(self):
-        return self._archive
+def _file_signature(filename):
+    """
+    Cheap fingerprint of a file on disk used to detect external changes.
+    Returns None if the file does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
 
-    def get_pokemon(self, individual_id):
-        if individual_id not in self.pokemon:
-            raise NoTrackedPokemon(individual_id)
-        return self.pokemon[individual_id]
 
-    def unique_id(self):
-        while self.counter in self.pokemon:
-            self.counter += 1
-        return self.counter
+def _tracker_signature(config_instance: Config):
+    if config_instance.uses_sqlite():
+        return _file_signature(config_instance.filename + SqliteStore.SUFFIX),
+    return (_file_signature(config_instance.filename),
+            _file_signature(config_instance.filename + Journal.SUFFIX))
 
-    def track(self, pokemon: Pokemon):
-        self.pokemon[pokemon.get_individual_id()] = pokemon
 
-    def untrack(self, pokemon: Pokemon):
-        individual_id = pokemon.get_individual_id()
-        del self.pokemon[individual_id]
-        self.remove_from_team(individual_id)
-        self.remove_from_archive(individual_id)
-        pokemon.delete()
+class Session(object):
+    """
+    Keeps the config and tracker resident in memory between commands, so
+    that a command does not have to re-parse the tracker file. The files are
+    only reloaded when they change on disk.
+    """
 
-    def __str__(self):
-        if len(self.pokemon):
-            return '\n'.join([pokemon.listing(self._team) for pokemon in self.pokemon.values()])
-        else:
-            return 'No tracked Pokemon'
+    def __init__(self):
+        self.config = None
+        self.tracker = None
+        self.history = None
+        self._config_signature = None
+        self._tracker_signature = None
+
+    def load(self, filename=None) -> Tracker:
+        config_signature = _file_signature(config.CONFIG_FILENAME)
+        if (self.config is None
+                or config_signature != self._config_signature
+                or (filename is not None and filename != self.config.filename)):
+            with timings.instance.phase('config_load'):
+                config_instance = Config.from_json(filename)
+            with timings.instance.phase('config_write'):
+                Config.to_json(config_instance)
+            self.config = config_instance
+            self._config_signature = _file_signature(config.CONFIG_FILENAME)
+            self._close_store()
+            self.tracker = None
+            pokedex.configure_cache(config_instance.species_cache_size)
+            configure_modifiers(config_instance)
+            if config_instance.eager_pokedex:
+                pokedex.preload()
+        config.instance = self.config
+
+        tracker_signature = _tracker_signature(self.config)
+        if self.tracker is None or tracker_signature != self._tracker_signature:
+            self._close_store()
+            # The tracker is read when first used, which is timed as tracker_load.
+            if self.config.uses_sqlite():
+                self.tracker = Tracker.from_sqlite(self.config.filename, self.config.fsync)
+            else:
+                self.tracker = Tracker.from_json(self.config.filename, self.config.fsync)
+            self.history = history.History(self.config.filename, self.config.fsync)
+            self._tracker_signature = tracker_signature
+        return self.tracker
+
+    def would_reload(self, filename=None) -> bool:
+        """Whether load(filename) would read the config or tracker from disk again."""
+        if self.config is None:
+            return False
+        return ((filename is not None and filename != self.config.filename)
+                or _file_signature(config.CONFIG_FILENAME) != self._config_signature
+                or _tracker_signature(self.config) != self._tracker_signature)
+
+    def saved(self):
+        """Record that the tracker file was written by this session."""
+        self._tracker_signature = _tracker_signature(self.config)
+
+    def _close_store(self):
+        if self.tracker is not None and self.tracker.store is not None:
+            self.tracker.store.close()
+
+    def close(self):
+        """Compact any journaled changes back into the tracker snapshot."""
+        if self.tracker is None and self.config is not None \
+                and os.path.exists(self.config.filename + Journal.SUFFIX):
+            self.load()
+        if self.tracker is not None and self.tracker.has_changes():
+            try:
+                if self.tracker.store is not None:
+                    with timings.instance.phase('database_write'):
+                        self.tracker.write_database()
+                else:
+                    _write_snapshot(self.tracker)
+                self.history.flush()
+                self.saved()
+            except TrackerConflict as e:
+                print('%s, the unsaved changes were discarded' % e)
+        self._close_store()
+        if self.config is not None and self.config.metrics_file:
+            timings.instance.append_to(self.config.metrics_file)
+
+    def invalidate(self):
+        """Discard the in-memory tracker so it is reloaded by the next command."""
+        self._close_store()
+        self.tracker = None
+        self.history = None
+
+
+_session = Session()
+_tracker: Tracker | None = None
+_history: history.History | None = None
 
 
-class NoActivePokemon(Exception):
+class _Batch(object):
     """
-    Raised when an operation that assumes the existence of an active Pokemon
-    is carried out and the team is empty.
+    Saving deferred by run_batch() or the daemon. Commands only mark the
+    tracker as dirty and the batch decides when to write it.
     """
-    pass
 
+    def __init__(self, rollback=True):
+        self.dirty = False
+        # Whether a failed command discards every change since the last save,
+        # or only its own changes.
+        self.rollback = rollback
 
-class NoTrackedPokemon(Exception):
-    """
-    Raised when an id is requested from a Tracker but the Tracker does not
-    have a Pokemon with the provided id.
-    """
 
-    def __init__(self, individual_id):
-        super(NoTrackedPokemon, self).__init__()
-        self.id = individual_id
+_batch: _Batch | None = None
 
+# Show the phase timings after every command, set by --timings.
+_show_timings = False
 
-_tracker: Tracker | None = None
+
+def _write_snapshot(tracker: Tracker):
+    if os.path.exists(tracker.filename):
+        with timings.instance.phase('backup'):
+            copyfile(tracker.filename, tracker.filename + '.bak')  # Create backup
+    with timings.instance.phase('serialise'):
+        tracker.to_json()
 
 
 def _save_tracker():
-    if os.path.exists(_tracker.filename):
-        copyfile(_tracker.filename, _tracker.filename + '.bak')  # Create backup
-    _tracker.to_json()
+    if _batch is not None:
+        _batch.dirty = True
+        return
+    _write_tracker()
+
+
+def _write_tracker():
+    if _tracker.store is not None:
+        with timings.instance.phase('database_write'):
+            _tracker.write_database()
+    elif config.instance.uses_journal() and _tracker.journal.length < config.instance.journal_threshold:
+        with timings.instance.phase('journal_write'):
+            _tracker.write_journal()
+    else:
+        _write_snapshot(_tracker)
+    _history.flush()
+    _session.saved()
+
+
+_YIELD_CONDITION = re.compile(r'^([a-z_-]+)\s*(?:(<=|>=|<|>|=)\s*(\d+))?$')
+
+
+def _parse_yields(conditions, minimum: dict, maximum: dict):
+    for condition in conditions:
+        match = _YIELD_CONDITION.match(condition.strip().lower())
+        if not match:
+            raise ValueError("Invalid yield '%s', expected for example speed>=2" % condition)
+        stat, symbol, value = match.groups()
+        stat = stat.replace('-', '_')
+        value = 1 if value is None else int(value)
+        if symbol in (None, '>='):
+            minimum[stat] = value
+        elif symbol == '>':
+            minimum[stat] = value + 1
+        elif symbol == '<=':
+            maximum[stat] = value
+        elif symbol == '<':
+            maximum[stat] = value - 1
+        else:
+            minimum[stat] = maximum[stat] = value
 
 
 def _cmd_ev(args):
-    print(pokedex.search(args.species))
+    if args.species is not None:
+        print(pokedex.search(args.species))
+        return
+    if args.yields is None and args.only is None:
+        print('Give a species, or --yields and --only to search by EV yield')
+        return
+    minimum, maximum = {}, {}
+    only = None if args.only is None else [stat.lower().replace('-', '_') for stat in args.only]
+    try:
+        _parse_yields(args.yields or [], minimum, maximum)
+        matches = pokedex.find_by_yield(minimum, maximum, only)
+    except ValueError as e:
+        print(e)
+        return
+    if len(matches) == 0:
+        print('No species match')
+    for species in matches[:args.limit]:
+        print(species)
 
 
 def _cmd_list(args):
@@ -161,9 +249,11 @@ def _cmd_track(args):
         form=species.form,
         name=args.name,
         item=args.item,
-        pokerus=args.pokerus
+        pokerus=args.pokerus,
+        created=time.time_ns() // 1000
     )
     _tracker.track(pokemon)
+    _history.record_track(_tracker, pokemon)
     _save_tracker()
     print(pokemon)
 
@@ -192,14 +282,45 @@ def _cmd_view_archive(args):
 
 def _cmd_box(args):
     detailed_view = args.detailed
-    for individual_id in _tracker.pokemon:
-        if not _tracker.on_team(individual_id) and not _tracker.in_archive(individual_id):
-            pokemon = _tracker.get_pokemon(individual_id)
+    for individual_id in _tracker.get_box():
+        pokemon = _tracker.get_pokemon(individual_id)
+        print()
+        if detailed_view:
+            print(pokemon.status())
+        else:
+            print(pokemon)
+
+
+def _cmd_find(args):
+    matches = _tracker.query(*args.filters)
+    if len(matches) == 0:
+        print('No matching Pokemon')
+    for pokemon in matches:
+        if args.detailed:
             print()
-            if detailed_view:
-                print(pokemon.status())
-            else:
-                print(pokemon)
+            print(pokemon.status(_tracker.get_location(pokemon.get_individual_id())))
+        else:
+            print(pokemon.listing(_tracker.get_team()))
+
+
+def _cmd_plan(args):
+    pokemon = _tracker.get_pokemon(args.id)
+    species_list = None
+    if args.species is not None:
+        species_list = [pokedex.search(name) for name in args.species]
+    training_plan = planner.plan(pokemon, species_list, vitamins=not args.no_vitamins,
+                                 feathers=not args.no_feathers)
+    if len(training_plan) == 0:
+        print(f'{pokemon} is already at its target EVs')
+        return
+    print(f'Plan for {pokemon}: {len(training_plan)} steps '
+          f'({training_plan.battles()} battles, {training_plan.consumables()} consumables)')
+    for step in training_plan.steps:
+        print(f'  {step}')
+    if not training_plan.optimal:
+        print('The search stopped early, a shorter plan may exist.')
+    result = training_plan.result()
+    print(result.format(adjustment_amounts=result - pokemon.evs, targets=pokemon.target_evs))
 
 
 def _cmd_deposit(args):
@@ -229,23 +350,14 @@ def _cmd_withdraw(args):
 def _cmd_status(args):
     individual_id = args.id
     pokemon = _tracker.get_pokemon(individual_id)
-    location = get_location(individual_id)
+    location = _tracker.get_location(individual_id)
     print(pokemon.status(location))
 
 
-def get_location(individual_id):
-    if _tracker.on_team(individual_id):
-        location = 'Team'
-    elif _tracker.in_archive(individual_id):
-        location = 'Archive'
-    else:
-        location = 'Box'
-    return location
-
-
 def _cmd_update(args):
     individual_id = args.id
     pokemon = _tracker.get_pokemon(individual_id)
+    before = {individual_id: history.state(_tracker, pokemon)}
     if args.pokerus is True:
         pokemon.pokerus = True
     if args.nopokerus is True:
@@ -270,8 +382,10 @@ def _cmd_update(args):
     if args.archive is True:
         _tracker.add_to_archive(individual_id)
         _tracker.remove_from_team(individual_id)
+    _tracker.mark_changed(pokemon)
+    _history.record('update', before, _tracker)
     _save_tracker()
-    location = get_location(individual_id)
+    location = _tracker.get_location(individual_id)
     print(pokemon.status(location))
 
 
@@ -280,7 +394,10 @@ def _cmd_vitamin(args):
     pokemon = _tracker.get_pokemon(individual_id)
     count = 1 if args.count is None else args.count
     modifier = pokemon.get_vitamin_ev_modifier(args.vitamin, count)
+    before = {individual_id: history.state(_tracker, pokemon)}
     pokemon.evs.capped_add(modifier)
+    _tracker.mark_changed(pokemon)
+    _history.record('vitamin', before, _tracker)
     _save_tracker()
     print(f'{pokemon} new EVs:')
     print(pokemon.evs.format(adjustment_amounts=modifier, targets=pokemon.target_evs))
@@ -289,8 +406,11 @@ def _cmd_vitamin(args):
 def _cmd_set_effort(args):
     individual_id = args.id
     pokemon = _tracker.get_pokemon(individual_id)
+    before = {individual_id: history.state(_tracker, pokemon)}
     pokemon.set_effort(hp=args.hp, attack=args.attack, defense=args.defense, special_attack=args.special_attack,
                        special_defense=args.special_defense, speed=args.speed)
+    _tracker.mark_changed(pokemon)
+    _history.record('set_effort', before, _tracker)
     _save_tracker()
     print(f'{pokemon} new EVs:')
     print(pokemon.evs)
@@ -301,6 +421,7 @@ def _cmd_set_target(args):
     pokemon = _tracker.get_pokemon(individual_id)
     pokemon.set_target(hp=args.hp, attack=args.attack, defense=args.defense, special_attack=args.special_attack,
                        special_defense=args.special_defense, speed=args.speed)
+    _tracker.mark_changed(pokemon)
     _save_tracker()
     print(f'{pokemon} new target EVs:')
     print(pokemon.evs.format(targets=pokemon.target_evs))
@@ -310,6 +431,7 @@ def _cmd_clear_target(args):
     individual_id = args.id
     pokemon = _tracker.get_pokemon(individual_id)
     pokemon.clear_target()
+    _tracker.mark_changed(pokemon)
     _save_tracker()
     print(f'{pokemon} target EVs cleared.')
     print(pokemon.evs.format())
@@ -329,23 +451,244 @@ def _cmd_battle(args):
     print(f'Battled {count} × {species.name} (#{species.id}) '
           + f'which has a base EV reward of {species.evs.as_modifier_string()}')
 
-    for individual_id in battling_ids:
-        pokemon = _tracker.get_pokemon(individual_id)
-        modifier = pokemon.get_battle_ev_modifier(species, count)
-        pokemon.evs.capped_add(modifier)
+    battling = [_tracker.get_pokemon(individual_id) for individual_id in battling_ids]
+    modifiers = [pokemon.get_battle_ev_modifier(species, count) for pokemon in battling]
+    before = {pokemon.id: history.state(_tracker, pokemon) for pokemon in battling}
+    EvSet.capped_add_all([(pokemon.evs, modifier) for pokemon, modifier in zip(battling, modifiers)])
 
+    for pokemon, modifier in zip(battling, modifiers):
+        _tracker.mark_changed(pokemon)
         print(f'\n{pokemon} new EVs:')
         print(pokemon.evs.format(adjustment_amounts=modifier, targets=pokemon.target_evs))
+    _history.record('battle', before, _tracker)
+    _save_tracker()
+
+
+class InvalidBattleLog(Exception):
+    """Raised when a line of a battle log can not be imported."""
+
+    def __init__(self, line_number, reason):
+        super(InvalidBattleLog, self).__init__('Line %d of the battle log: %s' % (line_number, reason))
+
+
+def _whole_number(value, line_number, what) -> int:
+    """A whole number from a JSON number or CSV field, rejecting fractions and other types."""
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            pass
+    elif isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise InvalidBattleLog(line_number, '%s must be a whole number, not %s' % (what, json.dumps(value)))
+
+
+def _battle_count(value, line_number) -> int:
+    count = _whole_number(value, line_number, 'count')
+    if count < 1:
+        raise InvalidBattleLog(line_number, 'count must be at least 1, not %d' % count)
+    return count
+
+
+def _battle_ids(values, line_number) -> list[int]:
+    if not isinstance(values, list):
+        raise InvalidBattleLog(line_number, 'ids must be a list, not %s' % json.dumps(values))
+    return [_whole_number(value, line_number, 'id') for value in values]
+
+
+def _read_battle_log(fp, log_format):
+    """
+    Yield (species, count, ids) records from a CSV or JSON lines battle log.
+    CSV rows are species, optional count and optional ids separated by
+    spaces or semicolons, with an optional 'species,count,ids' header row.
+    JSON lines hold objects with a 'species' key and optional 'count' and
+    'ids' keys. ids is None when the record applies to the team. Lines that
+    can not be read, and counts that are not whole numbers of at least 1,
+    raise InvalidBattleLog.
+    """
+    if log_format == 'jsonl':
+        for line_number, line in enumerate(fp, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise InvalidBattleLog(line_number, 'invalid JSON, %s' % e.msg)
+            if not isinstance(record, dict) or 'species' not in record:
+                raise InvalidBattleLog(line_number, "expected an object with a 'species' key")
+            ids = record.get('ids')
+            count = _battle_count(record['count'], line_number) if 'count' in record else 1
+            yield str(record['species']), count, None if ids is None else _battle_ids(ids, line_number)
+    else:
+        reader = csv.reader(fp)
+        for row in reader:
+            if not row or not row[0].strip() or row[0].strip().lower() == 'species':
+                continue
+            count = _battle_count(row[1], reader.line_num) if len(row) > 1 and row[1].strip() else 1
+            ids = row[2].replace(';', ' ').split() if len(row) > 2 and row[2].strip() else None
+            yield row[0].strip(), count, None if ids is None else _battle_ids(ids, reader.line_num)
+
+
+def _cmd_battle_import(args):
+    log_format = args.format
+    if log_format is None:
+        log_format = 'jsonl' if args.file.endswith(('.jsonl', '.json')) else 'csv'
+    try:
+        # Standard input is left open for the prompt and the rest of a batch.
+        fp = contextlib.nullcontext(sys.stdin) if args.file == '-' else open(args.file, 'r', newline='')
+    except IOError as e:
+        print(f"Could not read battle log '{args.file}': {e.strerror}")
+        return
+
+    team = [_tracker.get_pokemon(individual_id) for individual_id in _tracker.get_team()]
+    limits = EvSet.effort_limits()
+    stat_max, total_max = limits
+    species_by_name = {}
+    # Battle modifiers per (Pokemon id, species id, form), with whether they only add EVs.
+    modifiers = {}
+    starting_evs = {}
+    before = {}
+    # Pokemon at the total cap, which further EV gains cannot change.
+    saturated = set()
+    records = 0
+    battles = 0
+    with fp as log:
+        for name, count, ids in _read_battle_log(log, log_format):
+            species = species_by_name.get(name)
+            if species is None:
+                species = species_by_name[name] = pokedex.search(name)
+            if ids is None:
+                if len(team) == 0:
+                    raise NoActivePokemon()
+                battling = team
+            else:
+                battling = [_tracker.get_pokemon(individual_id) for individual_id in ids]
+
+            for pokemon in battling:
+                key = (pokemon.id, species.id, species.form)
+                if key not in modifiers:
+                    modifier = pokemon.get_battle_ev_modifier(species)
+                    modifiers[key] = modifier, min(modifier.to_dict().values()) >= 0
+                    if pokemon.id not in before:
+                        before[pokemon.id] = history.state(_tracker, pokemon)
+                        starting_evs[pokemon.id] = pokemon.evs.clone()
+                modifier, only_adds = modifiers[key]
+                if only_adds and pokemon.id in saturated:
+                    continue  # Nothing more can be gained.
+                evs = pokemon.evs
+                evs.capped_add(modifier * count if count != 1 else modifier, limits)
+                if evs.total_effort() == total_max and max(evs.to_dict().values()) <= stat_max:
+                    saturated.add(pokemon.id)
+                else:
+                    saturated.discard(pokemon.id)
+            records += 1
+            battles += count
+
+    print(f'Imported {records} records covering {battles} battles against {len(species_by_name)} species')
+    for individual_id, evs in starting_evs.items():
+        pokemon = _tracker.get_pokemon(individual_id)
+        _tracker.mark_changed(pokemon)
+        print(f'\n{pokemon} new EVs:')
+        print(pokemon.evs.format(adjustment_amounts=pokemon.evs - evs, targets=pokemon.target_evs))
+    _history.record('battle_import', before, _tracker)
     _save_tracker()
 
 
 def _cmd_release(args):
     pokemon = _tracker.get_pokemon(args.id)
+    released = history.snapshot(_tracker, pokemon)
     _tracker.untrack(pokemon)
+    _history.record_release(released)
     _save_tracker()
     print('No longer tracking %s' % pokemon)
 
 
+_RELATIVE_TIME = re.compile(r'^(\d+)\s*([smhdw])$')
+_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def _parse_time(text) -> float:
+    """A time given as an ISO date and time, or as a time ago such as 30m, 2h or 7d."""
+    match = _RELATIVE_TIME.match(text.strip().lower())
+    if match:
+        return time.time() - int(match.group(1)) * _SECONDS[match.group(2)]
+    try:
+        return datetime.datetime.fromisoformat(text.strip()).timestamp()
+    except ValueError:
+        raise ValueError("Invalid time '%s', expected for example 2024-05-01, '2024-05-01 18:30' or 2h" % text)
+
+
+def _describe_change(change: history.Change, undo=False, evs: EvSet = None) -> str:
+    """Describe a change, with evs as the EVs actually added if they were capped."""
+    amounts = change.ev_change(undo).to_dict() if evs is None else evs.to_dict()
+    parts = ['%s %+d' % (EvSet.label(stat), amount) for stat, amount in amounts.items() if amount != 0]
+    for field, values in change.fields.items():
+        old, new = reversed(values) if undo else values
+        if field == 'tracked':
+            parts.append('Released' if new is None else 'Tracked')
+            continue
+        if field == 'species':
+            old, new = history.species(old).name, history.species(new).name
+        parts.append('%s: %s -> %s' % (field.capitalize(), old, new))
+    return ', '.join(parts)
+
+
+def _cmd_history(args):
+    pokemon = _tracker.get_pokemon(args.id)
+    try:
+        since = None if args.since is None else _parse_time(args.since)
+        until = None if args.until is None else _parse_time(args.until)
+    except ValueError as e:
+        print(e)
+        return
+    entries = _history.for_pokemon(args.id, since, until, None if args.limit is None else max(args.limit, 0),
+                                   pokemon.created)
+    if len(entries) == 0:
+        print(f'No recorded changes to {pokemon}')
+        return
+    print(f'History of {pokemon}:')
+    for action, change in entries:
+        print('%s  %-13s %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(action.time)),
+                                action.command, _describe_change(change)))
+
+
+def _undo_or_redo(args, step, verb, undo):
+    steps = step(_tracker, args.count)
+    for action, applied in steps:
+        print('%s %s from %s' % (verb, action.command,
+                                 time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(action.time))))
+        for pokemon, change, added, evs in applied:
+            print(f'\n{pokemon}: {_describe_change(change, undo, added)}')
+            if change.evs:
+                print(evs.format(adjustment_amounts=added, targets=pokemon.target_evs))
+    if len(steps) < args.count:
+        print('Nothing to %s' % ('undo' if undo else 'redo'))
+    if steps:
+        _save_tracker()
+
+
+def _cmd_undo(args):
+    _undo_or_redo(args, _history.undo, 'Undid', True)
+
+
+def _cmd_redo(args):
+    _undo_or_redo(args, _history.redo, 'Redid', False)
+
+
+def _cmd_stats(args):
+    print(timings.instance.report())
+    info = pokedex.cache_info()
+    print()
+    print('Species cache: %d hits, %d misses, %d evictions, %d of %d cached, %.2f ms loading'
+          % (info.hits, info.misses, info.evictions, info.currsize, info.maxsize, info.load_time * 1000))
+
+
+def _print_timings(command, seconds, phases):
+    print('%s took %.2f ms' % (command, seconds * 1000))
+    for name, phase_seconds in sorted(phases.items(), key=lambda item: -item[1]):
+        print('  %-16s %10.2f ms' % (name, phase_seconds * 1000))
+
+
 def _build_parser():
     parser = argparse.ArgumentParser(
         prog='ev',
@@ -363,11 +706,21 @@ def _build_parser():
                              information to. This defaults to %s in your
                              home directory
                              ''' % config.DEFAULT_TRACKER_FILENAME)
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='Show the time spent in each phase of the command')
 
     subparsers = parser.add_subparsers()
 
-    ev_parser = subparsers.add_parser('ev', help='List Effort Values for a Pokemon')
-    ev_parser.add_argument('species', help='Name or number of Pokemon species to search for')
+    ev_parser = subparsers.add_parser('ev', help='List Effort Values for a Pokemon, or find species by yield',
+                                      epilog='Yields are a stat with an optional comparison, for example '
+                                             '"speed>=2" or "total=3". Stats are hp, attack, defense, '
+                                             'special_attack, special_defense, speed and total')
+    ev_parser.add_argument('species', nargs='?', help='Name or number of Pokemon species to search for')
+    ev_parser.add_argument('--yields', '-y', nargs='+', metavar='yield',
+                           help='Only list species whose yields match, most of the first stat first')
+    ev_parser.add_argument('--only', '-o', nargs='+', metavar='stat',
+                           help='Only list species yielding in none but these stats')
+    ev_parser.add_argument('--limit', '-l', type=int, help='List at most this many species')
     ev_parser.set_defaults(func=_cmd_ev)
 
     list_parser = subparsers.add_parser('list', help='List tracked Pokemon')
@@ -389,6 +742,22 @@ def _build_parser():
     box_parser.add_argument('--detailed', action='store_true', default=False)
     box_parser.set_defaults(func=_cmd_box)
 
+    find_parser = subparsers.add_parser('find', help='Find tracked Pokemon matching filters',
+                                        epilog='Filters: species=<species>, item=<item|none>, pokerus[=no], '
+                                               'location=<team|box|archive>, below_target[=<stat>], '
+                                               'evs.<stat><op><n>, remaining.<stat><op><n>, for example '
+                                               '"evs.speed<252"')
+    find_parser.add_argument('filters', nargs='+', metavar='filter', help='Filter to match, all must match')
+    find_parser.add_argument('--detailed', action='store_true', default=False)
+    find_parser.set_defaults(func=_cmd_find)
+
+    plan_parser = subparsers.add_parser('plan', help='Plan the fewest battles and consumables to reach target EVs')
+    plan_parser.add_argument('id', type=int, help='Pokemon to plan for')
+    plan_parser.add_argument('--species', '-s', nargs='+', help='Only battle these species')
+    plan_parser.add_argument('--no-vitamins', action='store_true', default=False, help='Do not use vitamins')
+    plan_parser.add_argument('--no-feathers', action='store_true', default=False, help='Do not use feathers')
+    plan_parser.set_defaults(func=_cmd_plan)
+
     view_archive_parser = subparsers.add_parser('view_archive', help='List the archived Pokemon')
     view_archive_parser.add_argument('--detailed', action='store_true', default=False)
     view_archive_parser.set_defaults(func=_cmd_view_archive)
@@ -464,22 +833,68 @@ def _build_parser():
     battle_parser.add_argument('--count', '-c', type=int)
     battle_parser.set_defaults(func=_cmd_battle)
 
+    battle_import_parser = subparsers.add_parser('battle_import', aliases=['battle-import'],
+                                                 help='Record the battles from a CSV or JSON lines battle log')
+    battle_import_parser.add_argument('file', help='Battle log to import, or - to read from standard input')
+    battle_import_parser.add_argument('--format', '-f', choices=['csv', 'jsonl'],
+                                      help='Format of the battle log, guessed from the file extension by default')
+    battle_import_parser.set_defaults(func=_cmd_battle_import)
+
     release_parser = subparsers.add_parser('release', help='Stop tracking a Pokemon')
     release_parser.add_argument('id', type=int)
     release_parser.set_defaults(func=_cmd_release)
 
+    history_parser = subparsers.add_parser('history', help='Show the recorded changes to a Pokemon',
+                                           epilog='Times are a date and time such as "2024-05-01 18:30", or a '
+                                                  'time ago such as 30m, 2h, 7d or 4w')
+    history_parser.add_argument('id', type=int, help='Pokemon to show the history of')
+    history_parser.add_argument('--since', '-s', help='Only show changes from this time on')
+    history_parser.add_argument('--until', '-u', help='Only show changes up to this time')
+    history_parser.add_argument('--limit', '-l', type=int, help='Show at most this many of the latest changes')
+    history_parser.set_defaults(func=_cmd_history)
+
+    undo_parser = subparsers.add_parser('undo', help='Undo the last battle, vitamin, set_effort or update')
+    undo_parser.add_argument('--count', '-c', type=int, default=1, help='Number of commands to undo')
+    undo_parser.set_defaults(func=_cmd_undo)
+
+    redo_parser = subparsers.add_parser('redo', help='Redo the last undone command')
+    redo_parser.add_argument('--count', '-c', type=int, default=1, help='Number of commands to redo')
+    redo_parser.set_defaults(func=_cmd_redo)
+
+    stats_parser = subparsers.add_parser('stats', help='Show command latencies and the time spent in each phase')
+    stats_parser.set_defaults(func=_cmd_stats)
+
     return parser
 
 
 def execute_command(args):
-    global _tracker
+    global _tracker, _history
+    timings.instance.start_command()
+    start_time = time.perf_counter()
     try:
-        config_instance = Config.from_json(args.filename)
-        config.instance = config_instance
-        Config.to_json(config_instance)
-        _tracker = Tracker.from_json(config_instance.filename)
-        args.func(args)
+        _tracker = _session.load(args.filename)
+        _history = _session.history
+        keep_unsaved = _batch is not None and not _batch.rollback
+        if keep_unsaved:
+            _tracker.checkpoint()
+        try:
+            with timings.instance.phase('command'):
+                args.func(args)
+        except BaseException:
+            # Drop any partially applied, unsaved changes.
+            if keep_unsaved:
+                _tracker.rollback()
+            else:
+                _session.invalidate()
+            raise
+        if keep_unsaved:
+            _tracker.release_checkpoint()
+        command = args.func.__name__[len('_cmd_'):]
+        phases = timings.instance.finish_command(command, time.perf_counter() - start_time)
+        if args.timings or _show_timings:
+            _print_timings(command, timings.instance.latencies[command][-1], phases)
         print()
+        return True
     except pokedex.NoSuchSpecies as e:
         print("No match found for '%s'." % e.identifier)
         if isinstance(e, pokedex.AmbiguousSpecies):
@@ -498,29 +913,139 @@ def execute_command(args):
         print("Add a pokemon to the team using the 'withdraw <id>' command.")
     except NoTrackedPokemon as e:
         print("No tracked Pokemon with id '%d' was found." % e.id)
+    except query.InvalidFilter as e:
+        print(e)
+    except planner.PlanningError as e:
+        print(e)
+    except InvalidBattleLog as e:
+        print(e)
+    except history.HistoryMismatch as e:
+        print(e)
+    except TrackerConflict as e:
+        print('%s, the changes were not saved.' % e)
+        print('The tracker has been reloaded, run the command again to apply it.')
+    return False
 
 
 def repl() -> None:
-    while True:
-        try:
-            _in = input(">> ")
-            if _in.lower() == "exit":
+    try:
+        while True:
+            try:
+                _in = input(">> ")
+                if _in.lower() == "exit":
+                    break
+            except KeyboardInterrupt:
+                print("\nExiting...")
                 break
-        except KeyboardInterrupt:
-            print("\nExiting...")
-            break
 
-        # noinspection PyBroadException
-        try:
-            args = _build_parser().parse_args(shlex.split(_in))
-        except BaseException:
-            continue
-        try:
-            execute_command(args)
-        except Exception as e:
-            print(f"Error: {e}\n")
-            break
+            # noinspection PyBroadException
+            try:
+                args = _build_parser().parse_args(shlex.split(_in))
+            except BaseException:
+                continue
+            try:
+                execute_command(args)
+            except Exception as e:
+                print(f"Error: {e}\n")
+                break
+    finally:
+        _session.close()
+
+
+def run_batch(lines, filename=None, commit_every=None) -> bool:
+    """
+    Run subcommands, one per line, against a single tracker kept in memory.
+    Blank lines and # comments are skipped and exit ends the batch. The
+    tracker is saved once at the end, or after every commit_every commands
+    that change it, and before it is reloaded because another file was given
+    or another session saved it. The first command that fails rolls back
+    every change since the last save and stops the batch. Returns whether
+    every command succeeded.
+    """
+    global _batch
+    parser = _build_parser()
+    _batch = _Batch()
+    pending = 0
+    try:
+        for line_number, line in enumerate(lines, 1):
+            error = None
+            try:
+                words = shlex.split(line, comments=True)
+                if not words:
+                    continue
+                if words == ['exit']:
+                    break
+                args = parser.parse_args(words)
+            except (ValueError, argparse.ArgumentError) as e:
+                error = str(e)
+            except SystemExit:
+                error = 'invalid command'
+            if error is None:
+                if args.filename is None:
+                    args.filename = filename
+                if pending > 0 and _session.would_reload(args.filename):
+                    # Loading the tracker again would drop the unsaved changes,
+                    # save them first, merged with the other session's.
+                    _write_tracker()
+                    pending = 0
+                _batch.dirty = False
+                try:
+                    if not execute_command(args):
+                        error = 'command failed'
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+            if error is not None:
+                _session.invalidate()
+                print(f"Line {line_number}: {error}, {pending} unsaved commands rolled back", file=sys.stderr)
+                return False
+            if _batch.dirty:
+                pending += 1
+                if commit_every is not None and pending >= commit_every:
+                    _write_tracker()
+                    pending = 0
+        if pending > 0:
+            _write_tracker()
+        return True
+    except TrackerConflict as e:
+        _session.invalidate()
+        print(f"{e}, {pending} unsaved commands rolled back", file=sys.stderr)
+        return False
+    finally:
+        _batch = None
+
+
+def main(argv=None) -> int:
+    global _show_timings
+    parser = argparse.ArgumentParser(
+        prog='ev-tracker',
+        description='Run the interactive prompt, or a batch of commands with --script or --stdin.',
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--script', metavar='FILE', help='Run the commands in FILE, one per line')
+    source.add_argument('--stdin', action='store_true', default=False,
+                        help='Run the commands read from standard input, one per line')
+    parser.add_argument('--commit-every', type=int, metavar='N',
+                        help='Save after every N commands that change the tracker instead of once at the end')
+    parser.add_argument('--infile', '-i', dest='filename', help='Tracker file for commands that do not give one')
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='Show the time spent in each phase after every command')
+    options = parser.parse_args(argv)
+    _show_timings = options.timings
+    if options.script is None and not options.stdin:
+        repl()
+        return 0
+    if options.commit_every is not None and options.commit_every < 1:
+        parser.error('--commit-every must be at least 1')
+    try:
+        if options.stdin:
+            succeeded = run_batch(sys.stdin, options.filename, options.commit_every)
+        else:
+            with open(options.script, 'r') as fp:
+                succeeded = run_batch(fp, options.filename, options.commit_every)
+    finally:
+        _session.close()
+    return 0 if succeeded else 1
 
 
 if __name__ == '__main__':
-    repl()
+    sys.exit(main())
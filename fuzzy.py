@@ -0,0 +1,60 @@
+"""
+Close match lookups for misspelt names.
+"""
+
+import difflib
+import heapq
+from collections import Counter
+
+
+class FuzzyIndex(object):
+    """
+    An index over a fixed set of names, each with an attached value, that
+    returns the same matches as difflib.get_close_matches without scoring
+    every name.
+
+    Every name is indexed by the characters it contains. A query adds up the
+    characters it shares with each name, which bounds the similarity ratio
+    from above, so only names that can still reach the cutoff are scored.
+    """
+
+    def __init__(self, entries=None):
+        self._keys = []
+        self._values = []
+        self._postings: dict[str, list[tuple[int, int]]] = {}
+        if entries is not None:
+            for key, value in dict(entries).items():
+                self.add(key, value)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key: str, value=None):
+        position = len(self._keys)
+        self._keys.append(key)
+        self._values.append(value)
+        for char, count in Counter(key).items():
+            self._postings.setdefault(char, []).append((position, count))
+
+    def get_close_matches(self, word: str, n=3, cutoff=0.6) -> list[tuple]:
+        """
+        Return up to n (name, value) pairs for the names closest to word,
+        best match first.
+        """
+        shared: dict[int, int] = {}
+        for char, word_count in Counter(word).items():
+            for position, key_count in self._postings.get(char, ()):
+                shared[position] = shared.get(position, 0) + min(word_count, key_count)
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        scored = []
+        for position, common in shared.items():
+            key = self._keys[position]
+            if 2.0 * common / (len(word) + len(key)) < cutoff:
+                continue
+            matcher.set_seq1(key)
+            ratio = matcher.ratio()
+            if ratio >= cutoff:
+                scored.append((ratio, key, position))
+        return [(key, self._values[position]) for _, key, position in heapq.nlargest(n, scored)]
@@ -0,0 +1,395 @@
+"""
+A log of the changes commands made to tracked Pokemon, for the history,
+undo and redo commands.
+
+Every action records, per Pokemon it changed, the change in EVs and the old
+and new values of the other fields it changed. Undoing an action subtracts
+its EV changes and restores the old values, so it costs the same however
+long the history is. Tracking and releasing a Pokemon are actions too, so
+undoing a release brings the Pokemon back. Changes also record when their
+Pokemon was first tracked, as released ids are used again, and are refused
+if the Pokemon with that id is a different one.
+
+The log is stored next to the tracker file as JSON lines: 'do' lines hold an
+action, 'undo' and 'redo' lines move back and forth through them. A new
+action after an undo drops the undone actions. Once the log grows past
+COMPACT_SIZE it is rewritten with only the last MAX_ACTIONS actions, so
+reading it costs the same however long the tracker has been used.
+"""
+
+import bisect
+import json
+import os
+import time
+
+import pokedex
+from pokemon import EvSet, Pokemon, Species
+from tracker import NoTrackedPokemon, replace_file
+
+# Fields other than the EVs that a command can change, as state() records them.
+FIELDS = ('species', 'name', 'item', 'pokerus', 'location')
+
+# Marks an id that no Pokemon is tracked with, while checking actions.
+_UNTRACKED = object()
+
+
+def state(tracker, pokemon: Pokemon) -> tuple[EvSet, dict]:
+    """The EVs and fields of a Pokemon, to compare with after a command."""
+    return pokemon.evs.clone(), {
+        'species': [pokemon.species.id, pokemon.species.form],
+        'name': pokemon.to_dict()['name'],
+        'item': pokemon.item_name,
+        'pokerus': pokemon.pokerus,
+        'location': tracker.get_location(pokemon.get_individual_id()).lower(),
+    }
+
+
+def snapshot(tracker, pokemon: Pokemon) -> dict:
+    """Everything needed to track a Pokemon again after it is released."""
+    return {'record': pokemon.to_dict(), 'species': [pokemon.species.id, pokemon.species.form],
+            'location': tracker.get_location(pokemon.get_individual_id()).lower()}
+
+
+def species(value) -> Species:
+    """The Species of a recorded [id, form] pair."""
+    species_id, form = value
+    forms = pokedex.fetch_by_id(species_id)
+    for match in forms.values():
+        if match.form == form:
+            return match
+    return next(iter(forms.values()))
+
+
+class HistoryMismatch(Exception):
+    """
+    Raised when undoing or redoing a change to a Pokemon that is no longer
+    the one the change was made to.
+    """
+
+    def __init__(self, individual_id, reason):
+        self.id = individual_id
+        super(HistoryMismatch, self).__init__('Can not apply the change to Pokemon %d, %s' % (individual_id, reason))
+
+
+class Change(object):
+    """What one action changed on one Pokemon."""
+
+    __slots__ = ('id', 'created', 'evs', 'fields')
+
+    def __init__(self, individual_id, evs: dict = None, fields: dict = None, created=None):
+        self.id = individual_id
+        # Pokemon.created of the changed Pokemon, None for Pokemon tracked
+        # before it was recorded.
+        self.created = created
+        # Nonzero EV changes by stat, and [old, new] values by field. The
+        # 'tracked' field holds a snapshot() for a tracked Pokemon, or None.
+        self.evs = evs or {}
+        self.fields = fields or {}
+
+    @classmethod
+    def between(cls, individual_id, before, after, created=None):
+        """The change from one state() to another, or None if nothing changed."""
+        evs = {stat: amount for stat, amount in (after[0] - before[0]).to_dict().items() if amount != 0}
+        fields = {field: [before[1][field], after[1][field]] for field in FIELDS
+                  if before[1][field] != after[1][field]}
+        if not evs and not fields:
+            return None
+        return cls(individual_id, evs, fields, created)
+
+    def ev_change(self, undo=False) -> EvSet:
+        change = EvSet(**self.evs)
+        return change * -1 if undo else change
+
+    def check(self, tracker, undo=False, created: dict = None):
+        """
+        Raise NoTrackedPokemon or HistoryMismatch if the change can not be
+        applied, or reversed, to the Pokemon with its id. created holds the
+        Pokemon.created of ids that earlier changes being checked track or
+        release, and is updated for this one.
+        """
+        if created is None:
+            created = {}
+        if self.id in created:
+            current = created[self.id]
+        elif self.id in tracker.pokemon:
+            current = tracker.get_pokemon(self.id).created
+        else:
+            current = _UNTRACKED
+        tracked = self.fields['tracked'][0 if undo else 1] if 'tracked' in self.fields else _UNTRACKED
+        if tracked is not _UNTRACKED and tracked is not None:
+            if current is not _UNTRACKED:
+                raise HistoryMismatch(self.id, 'its id is now used by another Pokemon')
+        elif current is _UNTRACKED:
+            raise NoTrackedPokemon(self.id)
+        elif current != self.created:
+            raise HistoryMismatch(self.id, 'the Pokemon it was made to was released')
+        if tracked is not _UNTRACKED:
+            created[self.id] = _UNTRACKED if tracked is None else self.created
+
+    def apply(self, tracker, undo=False) -> tuple[Pokemon, EvSet]:
+        """Apply the change, or reverse it, returning the Pokemon and the EVs actually added."""
+        if 'tracked' in self.fields:
+            return self._track(tracker, self.fields['tracked'][0 if undo else 1]), EvSet()
+        pokemon = tracker.get_pokemon(self.id)
+        before = pokemon.evs.clone()
+        # Other commands may have changed the EVs since, keep them within the caps.
+        pokemon.evs.capped_add(self.ev_change(undo))
+        for field, values in self.fields.items():
+            value = values[0] if undo else values[1]
+            if field == 'species':
+                pokemon.species = species(value)
+                pokemon.form = pokemon.species.form
+            elif field == 'location':
+                _move(tracker, self.id, value)
+            else:
+                setattr(pokemon, field, value)
+        tracker.mark_changed(pokemon)
+        return pokemon, pokemon.evs - before
+
+    def _track(self, tracker, tracked) -> Pokemon:
+        if tracked is None:
+            pokemon = tracker.get_pokemon(self.id)
+            tracker.untrack(pokemon)
+            return pokemon
+        pokemon = Pokemon.from_dict(dict(tracked['record']))
+        pokemon.species = species(tracked['species'])
+        pokemon.form = pokemon.species.form
+        tracker.track(pokemon)
+        _move(tracker, self.id, tracked['location'])
+        return pokemon
+
+    def to_dict(self) -> dict:
+        data = {'id': self.id}
+        if self.created is not None:
+            data['created'] = self.created
+        if self.evs:
+            data['evs'] = self.evs
+        if self.fields:
+            data['fields'] = self.fields
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data.get('evs'), data.get('fields'), data.get('created'))
+
+
+def _move(tracker, individual_id, location):
+    if location == 'team':
+        tracker.add_to_team(individual_id)
+        tracker.remove_from_archive(individual_id)
+    elif location == 'archive':
+        tracker.add_to_archive(individual_id)
+        tracker.remove_from_team(individual_id)
+    else:
+        tracker.remove_from_team(individual_id)
+        tracker.remove_from_archive(individual_id)
+
+
+class Action(object):
+    """The changes one command made, with the command's name and time."""
+
+    __slots__ = ('command', 'time', 'changes')
+
+    def __init__(self, command, when, changes: list[Change]):
+        self.command = command
+        self.time = when
+        self.changes = changes
+
+    def to_dict(self) -> dict:
+        return {'op': 'do', 'time': self.time, 'command': self.command,
+                'changes': [change.to_dict() for change in self.changes]}
+
+    def apply(self, tracker, undo=False) -> list[tuple[Pokemon, Change, EvSet, EvSet]]:
+        """
+        Apply the action, or reverse it, returning the changed Pokemon with
+        their change, the EVs actually added and their EVs afterwards. Check
+        the changes first.
+        """
+        applied = []
+        for change in self.changes:
+            pokemon, added = change.apply(tracker, undo)
+            applied.append((pokemon, change, added, pokemon.evs.clone()))
+        return applied
+
+
+class History(object):
+    """The action log of a tracker file, read when first used."""
+
+    SUFFIX = '.history'
+    # Actions kept when the log is compacted, and the log size that triggers it.
+    MAX_ACTIONS = 1000
+    COMPACT_SIZE = 1 << 20
+
+    def __init__(self, tracker_filename, fsync='full'):
+        self.filename = tracker_filename + History.SUFFIX
+        self.fsync = fsync
+        self._actions: list[Action] = []
+        # Actions before this position are applied, the rest can be redone.
+        self._position = 0
+        # Indexes into _actions of the actions that changed each Pokemon.
+        self._by_pokemon: dict[int, list[int]] = {}
+        # Log lines not yet written, written with the tracker by flush().
+        self._pending: list[dict] = []
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.filename, 'r') as fp:
+                lines = fp.read().splitlines()
+        except IOError:
+            lines = []  # Nothing recorded yet.
+        # Decoding every line with one call is much faster than a call per line.
+        try:
+            entries = json.loads('[' + ','.join(lines) + ']')
+        except ValueError:
+            entries = []
+            for line in lines:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break  # A partially written trailing entry, ignore it.
+        for entry in entries + self._pending:
+            self._replay(entry)
+
+    def _replay(self, entry):
+        if entry['op'] == 'do':
+            self._add(Action(entry['command'], entry['time'], [Change.from_dict(data) for data in entry['changes']]))
+        elif entry['op'] == 'undo' and self._position > 0:
+            self._position -= 1
+        elif entry['op'] == 'redo' and self._position < len(self._actions):
+            self._position += 1
+
+    def _add(self, action: Action):
+        # Drop the undone actions, which are always the last ones of each Pokemon.
+        while len(self._actions) > self._position:
+            for change in self._actions.pop().changes:
+                self._by_pokemon[change.id].pop()
+        index = len(self._actions)
+        self._actions.append(action)
+        for change in action.changes:
+            self._by_pokemon.setdefault(change.id, []).append(index)
+        self._position = index + 1
+
+    def _log(self, entry):
+        self._pending.append(entry)
+        if self._loaded:
+            self._replay(entry)
+
+    def record(self, command, before: dict, tracker):
+        """
+        Add an action for a command, given the state() of the Pokemon it may
+        have changed from before it ran, by id. Nothing is added if none of
+        them changed.
+        """
+        changes = []
+        for individual_id, old_state in before.items():
+            pokemon = tracker.get_pokemon(individual_id)
+            change = Change.between(individual_id, old_state, state(tracker, pokemon), pokemon.created)
+            if change is not None:
+                changes.append(change)
+        self._record(command, changes)
+
+    def _record(self, command, changes: list[Change]):
+        if changes:
+            self._log(Action(command, time.time(), changes).to_dict())
+
+    def record_track(self, tracker, pokemon: Pokemon):
+        """Add an action for a newly tracked Pokemon."""
+        self._record('track', [Change(pokemon.id, fields={'tracked': [None, snapshot(tracker, pokemon)]},
+                                      created=pokemon.created)])
+
+    def record_release(self, released: dict):
+        """Add an action for a released Pokemon, given its snapshot() from before it was released."""
+        record = released['record']
+        self._record('release', [Change(record['id'], fields={'tracked': [released, None]},
+                                        created=record.get('created'))])
+
+    def _step(self, tracker, actions: list[Action], undo) -> list[tuple[Action, list]]:
+        # Check every step before applying any, so that a mismatch part way
+        # through leaves the tracker and the log as they were.
+        created = {}
+        for action in actions:
+            for change in action.changes:
+                change.check(tracker, undo, created)
+        applied = []
+        for action in actions:
+            applied.append((action, action.apply(tracker, undo)))
+            self._log({'op': 'undo' if undo else 'redo', 'time': time.time()})
+        return applied
+
+    def undo(self, tracker, count=1) -> list[tuple[Action, list]]:
+        """
+        Reverse up to count applied actions, newest first, returning each
+        with what Action.apply returned. NoTrackedPokemon or HistoryMismatch
+        is raised before anything changes if one of them does not fit.
+        """
+        self._load()
+        start = max(self._position - count, 0)
+        return self._step(tracker, self._actions[start:self._position][::-1], True)
+
+    def redo(self, tracker, count=1) -> list[tuple[Action, list]]:
+        """Apply up to count undone actions again, oldest first, like undo()."""
+        self._load()
+        return self._step(tracker, self._actions[self._position:self._position + max(count, 0)], False)
+
+    def for_pokemon(self, individual_id, since=None, until=None, limit=None,
+                    created=None) -> list[tuple[Action, Change]]:
+        """
+        The applied actions that changed a Pokemon, oldest first, optionally
+        between two times and only the latest limit of them. Only changes to
+        the Pokemon tracked at the given created time are included, not to
+        earlier Pokemon that had the same id.
+        """
+        self._load()
+        indexes = self._by_pokemon.get(individual_id, [])
+        start, end = 0, bisect.bisect_left(indexes, self._position)
+
+        def action_time(index):
+            return self._actions[index].time
+        if since is not None:
+            start = bisect.bisect_left(indexes, since, 0, end, key=action_time)
+        if until is not None:
+            end = bisect.bisect_right(indexes, until, start, end, key=action_time)
+        result = []
+        actions = 0
+        for index in reversed(indexes[start:end]):
+            if limit is not None and actions >= limit:
+                break
+            action = self._actions[index]
+            changes = [change for change in action.changes
+                       if change.id == individual_id and change.created == created]
+            if changes:
+                actions += 1
+                result.extend((action, change) for change in reversed(changes))
+        result.reverse()
+        return result
+
+    def flush(self):
+        """Append the actions, undos and redos since the last flush to the log file."""
+        if not self._pending:
+            return
+        with open(self.filename, 'a') as fp:
+            fp.write(''.join(json.dumps(entry) + '\n' for entry in self._pending))
+            if self.fsync != 'off':
+                fp.flush()
+                os.fsync(fp.fileno())
+            size = fp.tell()
+        self._pending = []
+        if size > History.COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the log with only the last MAX_ACTIONS actions, and which of them are undone."""
+        self._load()
+        dropped = max(len(self._actions) - History.MAX_ACTIONS, 0)
+        now = time.time()
+        entries = [action.to_dict() for action in self._actions[dropped:]]
+        entries += [{'op': 'undo', 'time': now}] * (len(self._actions) - max(self._position, dropped))
+        replace_file(self.filename, lambda fp: fp.write(''.join(json.dumps(entry) + '\n' for entry in entries)),
+                     self.fsync)
+        self._actions, self._position, self._by_pokemon = [], 0, {}
+        for entry in entries:
+            self._replay(entry)
@@ -0,0 +1,427 @@
+"""
+Planning the fewest battles and consumables that take a Pokemon's effort
+values exactly to its targets.
+
+Every battle against a species and every consumable adds a fixed vector of
+effort values, so a plan is a set of counts, one per vector, that adds up to
+the remaining effort. Vectors that add to a single stat are solved per stat
+with a one dimensional dynamic program over the remaining effort. Vectors
+that add to several stats, from species with mixed yields or from a held
+Power item, are chosen by a branch and bound search on top of that, bounded
+by the linear programming relaxation of the remaining effort.
+"""
+
+import math
+
+import pokedex
+from pokemon import VITAMINS, EvSet, Pokemon, get_berry_reduction_amount, modifier_tables
+
+_STATS = EvSet.STATS
+
+# Plans are compared by their number of steps, then by the number of
+# consumables, so that of two equally long plans the one battling more wins.
+_STEP_COST = 1 << 10
+_CONSUMABLE_COST = 1
+_INFINITY = float('inf')
+
+# Search nodes explored before settling for the best plan found so far.
+SEARCH_BUDGET = 20000
+
+_yield_table: dict[tuple, list] | None = None
+
+
+class PlanningError(Exception):
+    """
+    Raised when no plan can take a Pokemon to its target EVs.
+    """
+    pass
+
+
+def _species_by_yield(species_list=None) -> dict[tuple, list]:
+    """
+    Group species by their base EV yield. The table for the whole pokedex is
+    built once and reused.
+    """
+    global _yield_table
+    if species_list is None and _yield_table is not None:
+        return _yield_table
+    table = {}
+    for species in pokedex.all_species() if species_list is None else species_list:
+        key = tuple(getattr(species.evs, stat) for stat in _STATS)
+        if any(key):
+            names = table.setdefault(key, [])
+            if species not in names:
+                names.append(species)
+    if species_list is None:
+        _yield_table = table
+    return table
+
+
+def _consumables():
+    """
+    Split the consumables in VITAMINS into the ones adding to a single stat,
+    keyed by (stat index, amount), and the berries reducing a stat, keyed by
+    stat index.
+    """
+    additions = {}
+    berries = {}
+    for name, effect in VITAMINS.items():
+        change = effect(EvSet()).to_dict()
+        changed = [(index, change[stat]) for index, stat in enumerate(_STATS) if change[stat] != 0]
+        if len(changed) != 1:
+            continue
+        index, amount = changed[0]
+        if amount > 0:
+            additions.setdefault((index, amount), name)
+        else:
+            berries.setdefault(index, name)
+    return additions, berries
+
+
+class Step(object):
+    """One kind of battle or consumable in a plan, used count times."""
+
+    def __init__(self, name, count, modifier: EvSet = None, species=()):
+        self.name = name
+        self.count = count
+        self.modifier = modifier
+        self.species = list(species)
+
+    def is_battle(self):
+        return len(self.species) > 0
+
+    def change(self, evs: EvSet) -> EvSet:
+        """The EVs added by one use of this step to a Pokemon with evs."""
+        if self.modifier is not None:
+            return self.modifier
+        return modifier_tables().consumable_change(self.name, evs)
+
+    def __str__(self):
+        if self.is_battle():
+            names = []
+            for species in self.species:
+                if species.name not in names:
+                    names.append(species.name)
+            others = '' if len(names) <= 3 else ' or %d others' % (len(names) - 3)
+            return '%d × battle %s%s (%s each)' % (self.count, ', '.join(names[:3]), others,
+                                                  self.modifier.as_modifier_string())
+        return '%d × %s' % (self.count, self.name)
+
+
+class Plan(object):
+
+    def __init__(self, pokemon: Pokemon, steps: list[Step], optimal=True):
+        self.pokemon = pokemon
+        self.steps = steps
+        self.optimal = optimal
+
+    def battles(self):
+        return sum(step.count for step in self.steps if step.is_battle())
+
+    def consumables(self):
+        return sum(step.count for step in self.steps if not step.is_battle())
+
+    def __len__(self):
+        return sum(step.count for step in self.steps)
+
+    def result(self) -> EvSet:
+        """Apply the plan to a copy of the Pokemon's EVs, one use at a time."""
+        evs = self.pokemon.evs.clone()
+        limits = EvSet.effort_limits()
+        for step in self.steps:
+            for _ in range(step.count):
+                evs.capped_add(step.change(evs), limits)
+        return evs
+
+
+def _single_stat_table(moves, remaining, can_overshoot):
+    """
+    Dynamic program over the effort remaining in one stat. Returns the
+    cheapest cost of adding exactly n effort for every n up to remaining,
+    or at least n if the stat can overshoot into its cap, with the position
+    of the move chosen last.
+    """
+    costs = [0] + [_INFINITY] * remaining
+    choices = [None] * (remaining + 1)
+    for amount in range(1, remaining + 1):
+        for position, move in enumerate(moves):
+            move_amount, move_cost = move[0], move[1]
+            if move_amount > amount and not can_overshoot:
+                continue
+            cost = move_cost + costs[max(amount - move_amount, 0)]
+            if cost < costs[amount]:
+                costs[amount] = cost
+                choices[amount] = position
+    return costs, choices
+
+
+def _covering_duals(vectors, remaining, can_overshoot):
+    """
+    Solve the linear programming relaxation of reaching remaining with the
+    fewest vectors, min sum(x) subject to sum(x[j] * vectors[j]) == remaining,
+    or >= for stats that can overshoot, with the dual simplex method. Returns
+    the optimal dual weights, one per stat, or None if remaining can not be
+    reached. Any x reaching some effort r costs at least sum(r[i] * weights[i])
+    as every vector costs at least its weighted sum.
+    """
+    # Each equality is a pair of >= rows, one with the signs flipped.
+    constraints = [(index, 1.0) for index in range(len(remaining))]
+    constraints += [(index, -1.0) for index in range(len(remaining)) if not can_overshoot[index]]
+    rows = len(constraints)
+    columns = len(vectors)
+    # Rows of -A x + s = -r with the slack s as the starting basis.
+    tableau = [[-sign * vector[index] for vector in vectors] + [1.0 if slack == row else 0.0 for slack in range(rows)]
+               + [-sign * remaining[index]] for row, (index, sign) in enumerate(constraints)]
+    costs = [1.0] * columns + [0.0] * (rows + 1)
+    for _ in range(8 * (rows + columns)):
+        pivot_row = min(range(rows), key=lambda row: tableau[row][-1])
+        if tableau[pivot_row][-1] > -1e-9:
+            break
+        row = tableau[pivot_row]
+        pivot_column = None
+        for column in range(columns + rows):
+            if row[column] < -1e-9:
+                ratio = costs[column] / -row[column]
+                if pivot_column is None or ratio < best_ratio - 1e-12:
+                    pivot_column, best_ratio = column, ratio
+        if pivot_column is None:
+            return None
+        pivot = row[pivot_column]
+        row = tableau[pivot_row] = [value / pivot for value in row]
+        for other in range(rows):
+            factor = tableau[other][pivot_column]
+            if other != pivot_row and factor != 0.0:
+                tableau[other] = [value - factor * pivot_value for value, pivot_value in zip(tableau[other], row)]
+        factor = costs[pivot_column]
+        costs = [value - factor * pivot_value for value, pivot_value in zip(costs, row)]
+    weights = [0.0] * len(remaining)
+    for row, (index, sign) in enumerate(constraints):
+        weights[index] += sign * max(costs[columns + row], 0.0)
+    return weights
+
+
+class _Search(object):
+    """Branch and bound over the counts of the multi stat battles."""
+
+    def __init__(self, vectors, singles, tables, exact_tables, remaining, can_overshoot, budget):
+        self.vectors = vectors
+        self.tables = tables
+        self.can_overshoot = can_overshoot
+        self.budget = budget
+        self.exhausted = False
+        self.nodes = 0
+        self.seen = {}
+        # Bound each position with a Lagrangian relaxation, using the duals of
+        # the linear relaxation that only has the vectors from that position
+        # on. The duals stay feasible for whatever effort is left there, and
+        # the single stat moves keep their exact costs, so for each stat the
+        # bound is w * r + min(cost(y) - w * y for y <= r), kept as a table.
+        self.offsets = []
+        for position in range(len(vectors) + 1):
+            weights = _covering_duals(vectors[position:] + singles, remaining, can_overshoot)
+            if weights is None:
+                self.offsets.append(None)
+                continue
+            offsets = []
+            for weight, (costs, _) in zip(weights, tables):
+                lowest = 0.0
+                offset = []
+                for amount, cost in enumerate(costs):
+                    if cost != _INFINITY:
+                        lowest = min(lowest, cost // _STEP_COST - weight * amount)
+                    offset.append(weight * amount + lowest)
+                offsets.append(offset)
+            self.offsets.append(offsets)
+        # Battling count of a vector is never optimal once single stat moves
+        # add the same effort in fewer steps, which bounds each count.
+        self.most = []
+        for vector in vectors:
+            count = 1
+            while count <= max(remaining):
+                singles_cost = sum(exact_tables[index][0][count * amount] // _STEP_COST
+                                   for index, amount in enumerate(vector)
+                                   if amount > 0 and count * amount < len(exact_tables[index][0]))
+                if singles_cost < count:
+                    break
+                count += 1
+            self.most.append(count - 1)
+        self.counts = [0] * len(vectors)
+        self.best_cost = self._leaf_cost(remaining)
+        self.best_counts = list(self.counts)
+        self.best_remaining = remaining
+
+    def _leaf_cost(self, remaining):
+        cost = 0
+        for stat_remaining, (costs, _) in zip(remaining, self.tables):
+            cost += costs[stat_remaining]
+        return cost
+
+    def _bound(self, position, remaining):
+        offsets = self.offsets[position]
+        if offsets is None:
+            return _INFINITY
+        value = 0.0
+        for stat_remaining, offset in zip(remaining, offsets):
+            value += offset[stat_remaining]
+        return math.ceil(value - 1e-6) * _STEP_COST
+
+    def run(self, position, remaining, cost):
+        if self.exhausted:
+            return
+        # Finishing with single stat moves gives a plan at every node, which
+        # finds good plans early.
+        total = cost + self._leaf_cost(remaining)
+        if total < self.best_cost:
+            self.best_cost = total
+            self.best_counts = list(self.counts)
+            self.best_remaining = remaining
+        if position == len(self.vectors):
+            return
+        if cost + self._bound(position, remaining) >= self.best_cost:
+            return
+        # The same effort left at an earlier position, reached at no more
+        # cost, has every plan from here among its own plans. Nodes are only
+        # recorded once searched, as a node's first child, battling no more of
+        # its vector, leaves the same effort.
+        reached = self.seen.setdefault(remaining, [])
+        for earlier_position, earlier_cost in reached:
+            if earlier_position <= position and earlier_cost <= cost:
+                return
+        self.nodes += 1
+        if self.nodes > self.budget:
+            self.exhausted = True
+            return
+
+        # Stats that can overshoot are clipped at their cap, so only the
+        # others limit the count, unless every stat can overshoot.
+        vector = self.vectors[position]
+        exact = [remaining[index] // amount for index, amount in enumerate(vector)
+                 if amount > 0 and not self.can_overshoot[index]]
+        if exact:
+            most = min(exact)
+        else:
+            most = max(-(-remaining[index] // amount) for index, amount in enumerate(vector) if amount > 0)
+        most = min(most, self.most[position])
+        for count in range(most, -1, -1):
+            self.counts[position] = count
+            after = tuple(max(stat_remaining - count * amount, 0)
+                          for stat_remaining, amount in zip(remaining, vector))
+            self.run(position + 1, after, cost + count * _STEP_COST)
+        self.counts[position] = 0
+        reached.append((position, cost))
+
+
+def plan(pokemon: Pokemon, species_list=None, vitamins=True, feathers=True, budget=SEARCH_BUDGET) -> Plan:
+    """
+    Plan the fewest battles and consumables taking pokemon's EVs to its target
+    EVs. Only stats with a target are trained; the others must stay as they
+    are. species_list restricts the battles to the given species, vitamins and
+    feathers allow the +10 and +1 consumables. Berries are used to lower a
+    stat that is above its target.
+    """
+    for can_overshoot_caps in (True, False):
+        result = _plan(pokemon, species_list, vitamins, feathers, budget, can_overshoot_caps)
+        final = result.result()
+        if all(getattr(final, stat) == getattr(pokemon.target_evs, stat) or getattr(pokemon.target_evs, stat) == 0
+               for stat in _STATS):
+            return result
+    raise PlanningError('No plan reaches the targets exactly without going over the total EV cap')
+
+
+def _plan(pokemon: Pokemon, species_list, vitamins, feathers, budget, can_overshoot_caps) -> Plan:
+    stat_max, total_max = EvSet.effort_limits()
+    evs = [getattr(pokemon.evs, stat) for stat in _STATS]
+    targets = [getattr(pokemon.target_evs, stat) for stat in _STATS]
+    targeted = [target > 0 for target in targets]
+    if not any(targeted):
+        raise PlanningError('%s has no target EVs' % pokemon)
+    for index, target in enumerate(targets):
+        if target > stat_max:
+            raise PlanningError('The %s target of %d is over the cap of %d EVs'
+                                % (EvSet.label(_STATS[index]), target, stat_max))
+    if sum(target if targeted[index] else evs[index] for index, target in enumerate(targets)) > total_max:
+        raise PlanningError('The targets add up to more than the cap of %d EVs' % total_max)
+
+    additions, berries = _consumables()
+    steps = []
+
+    # Berries first, for stats that are over their target.
+    for index, stat in enumerate(_STATS):
+        if targeted[index] and evs[index] > targets[index]:
+            if index not in berries:
+                raise PlanningError('Nothing lowers %s EVs' % EvSet.label(stat))
+            count = 0
+            while evs[index] > targets[index]:
+                evs[index] = max(evs[index] - get_berry_reduction_amount(evs[index]), 0)
+                count += 1
+            steps.append(Step(berries[index], count))
+
+    remaining = tuple(targets[index] - evs[index] if targeted[index] else 0 for index in range(len(_STATS)))
+    can_overshoot = tuple(can_overshoot_caps and targeted[index] and targets[index] == stat_max
+                          for index in range(len(_STATS)))
+    if not any(remaining):
+        return Plan(pokemon, steps)
+
+    # Moves adding to a single stat: (amount, cost, step name, species).
+    singles = [[] for _ in _STATS]
+    for (index, amount), name in additions.items():
+        if (amount == 1 and feathers) or (amount > 1 and vitamins):
+            singles[index].append((amount, _STEP_COST + _CONSUMABLE_COST, name, None))
+
+    battles: dict[tuple, list] = {}
+    for yield_species in _species_by_yield(species_list).values():
+        modifier = pokemon.get_battle_ev_modifier(yield_species[0])
+        vector = tuple(getattr(modifier, stat) for stat in _STATS)
+        usable = all(amount == 0 or (remaining[index] > 0 and (amount <= remaining[index] or can_overshoot[index]))
+                     for index, amount in enumerate(vector))
+        if usable and any(vector):
+            battles.setdefault(vector, []).extend(yield_species)
+
+    multi = []
+    for vector, vector_species in battles.items():
+        stats = [index for index, amount in enumerate(vector) if amount > 0]
+        if len(stats) == 1:
+            singles[stats[0]].append((vector[stats[0]], _STEP_COST, None, (vector, vector_species)))
+        else:
+            multi.append((vector, vector_species))
+
+    tables = [_single_stat_table(singles[index], remaining[index], can_overshoot[index])
+              for index in range(len(_STATS))]
+
+    # Try the vectors worth most under the relaxation first, so that good
+    # plans are found early and prune the rest of the search.
+    single_vectors = [tuple(move[0] if other == index else 0 for other in range(len(_STATS)))
+                      for index in range(len(_STATS)) for move in singles[index]]
+    weights = (_covering_duals([vector for vector, _ in multi] + single_vectors, remaining, can_overshoot)
+               or [0.0] * len(_STATS))
+    multi.sort(key=lambda entry: -sum(amount * weight for amount, weight in zip(entry[0], weights)))
+
+    exact_tables = [_single_stat_table(singles[index], stat_max, False) for index in range(len(_STATS))]
+    search = _Search([vector for vector, _ in multi], single_vectors, tables, exact_tables, remaining, can_overshoot,
+                     budget)
+    search.run(0, remaining, 0)
+    if search.best_cost == _INFINITY:
+        raise PlanningError('No combination of the available battles and consumables reaches the targets exactly')
+
+    for (vector, vector_species), count in zip(multi, search.best_counts):
+        if count > 0:
+            steps.append(Step(None, count, EvSet(*vector), vector_species))
+
+    for index, stat_remaining in enumerate(search.best_remaining):
+        _, choices = tables[index]
+        counts = {}
+        while stat_remaining > 0:
+            position = choices[stat_remaining]
+            counts[position] = counts.get(position, 0) + 1
+            stat_remaining = max(stat_remaining - singles[index][position][0], 0)
+        for position, count in sorted(counts.items(), key=lambda item: -singles[index][item[0]][0]):
+            _, _, name, battle = singles[index][position]
+            if battle is not None:
+                vector, vector_species = battle
+                steps.append(Step(None, count, EvSet(*vector), vector_species))
+            else:
+                steps.append(Step(name, count))
+
+    # Berries, then battles, then the other consumables.
+    steps.sort(key=lambda step: 0 if step.name in berries.values() else 1 if step.is_battle() else 2)
+    return Plan(pokemon, steps, optimal=not search.exhausted)
@@ -2,45 +2,235 @@
 A module for retrieving data about Pokemon species.
 """
 
-import difflib
+import bisect
 import os
 import sqlite3
+import time
+from collections import OrderedDict, namedtuple
 
+import timings
+from fuzzy import FuzzyIndex
+from pokedex import snapshot
+from pokedex.names import name_key
 from pokemon import Species, EvSet
 
-__all__ = ['NoSuchSpecies', 'AmbiguousSpecies', 'AmbiguousForm', 'fetch_by_id', 'fetch_by_name', 'search']
+__all__ = ['NoSuchSpecies', 'AmbiguousSpecies', 'AmbiguousForm', 'CacheInfo', 'YIELD_STATS', 'all_species',
+           'cache_info', 'close_matches', 'configure_cache', 'fetch_by_id', 'fetch_by_name', 'fetch_many',
+           'fetch_many_by_name', 'find_by_yield', 'name_key', 'preload', 'search', 'top_yielders']
 
 
 _DB_FILE = os.path.join(os.path.dirname(__file__), 'pokedex.db')
-_connection = sqlite3.connect(_DB_FILE)
-_connection.row_factory = sqlite3.Row
+_connection: sqlite3.Connection | None = None
+
+# The precompiled snapshot is used instead of the database when it is current.
+_snapshot = snapshot.load(_DB_FILE)
+
+_SELECT_SPECIES = '''SELECT p.id AS id, name, ev_hp, ev_attack, ev_defense,
+                     ev_special_attack, ev_special_defense, ev_speed, form
+                     FROM pokemon AS p
+                     JOIN stats AS s ON p.id = s.pokemon_id'''
+
+# The column names are looked up by. Databases without a filled name_key
+# column, built before it was added or straight from pokedex.sql without
+# python -m pokedex.build, fall back to computing the key for every row.
+_COLUMNS = {'id': 'p.id', 'name': 'p.name_key'}
+_FALLBACK_NAME_COLUMN = 'name_key(name)'
+
+# Query text per (field, number of values). Reusing the same text lets
+# sqlite3 reuse the prepared statement from its statement cache.
+_statements: dict[tuple[str, int], str] = {}
+
+# Keep bulk queries below SQLite's default host parameter limit.
+_MAX_QUERY_PARAMETERS = 500
+
+
+def _connect() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(_DB_FILE)
+        _connection.row_factory = sqlite3.Row
+        columns = [row['name'] for row in _connection.execute('PRAGMA table_info(pokemon)')]
+        if 'name_key' not in columns or _connection.execute(
+                'SELECT 1 FROM pokemon WHERE name_key IS NULL LIMIT 1').fetchone() is not None:
+            _connection.create_function('name_key', 1, name_key, deterministic=True)
+            _COLUMNS['name'] = _FALLBACK_NAME_COLUMN
+    return _connection
+
+
+def _statement(field, count) -> str:
+    key = (field, count)
+    if key not in _statements:
+        _connect()
+        if count == 1:
+            condition = '%s = ?' % _COLUMNS[field]
+        else:
+            condition = '%s IN (%s)' % (_COLUMNS[field], ', '.join('?' * count))
+        _statements[key] = '%s WHERE %s ORDER BY s.rowid' % (_SELECT_SPECIES, condition)
+    return _statements[key]
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize', 'load_time'])
 
 
 class _SpeciesCache(object):
     """
-    A very simple caching mechanism for database species records. There are
-    kept in memory until requested again.
+    A bounded cache of database species records that evicts the least
+    recently used species once it is full. Each entry holds every form of a
+    species and can be found by id, by the name_key() of its name or of a
+    'name (form)' string. Hits, misses, evictions and the time spent loading
+    rows are counted for cache_info().
     """
 
-    def __init__(self):
-        self._cache = {'id': {}, 'name': {}}
-        self.names = None
-
-    def contains(self, field, value) -> bool:
-        return field in self._cache and value in self._cache[field]
-
-    def get(self, field, value) -> dict[str, Species]:
-        return self._cache[field][value]
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[int, dict[str, Species]] = OrderedDict()
+        self._names: dict[str, int] = {}
+        self._forms: dict[str, tuple[int, str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def get(self, field, value) -> dict[str, Species] | None:
+        species_id = value if field == 'id' else self._names.get(value)
+        if species_id not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(species_id)
+        return self._entries[species_id]
+
+    def get_form(self, query: str) -> Species | None:
+        """
+        Look up a single form by the key of its 'name (form)' string. Misses
+        are not counted, as the caller falls back to a counted lookup.
+        """
+        if query not in self._forms:
+            return None
+        species_id, form = self._forms[query]
+        self.hits += 1
+        self._entries.move_to_end(species_id)
+        return self._entries[species_id][form]
 
     def add(self, species: dict[str, Species]):
         first_species = list(species.values())[0]
-        self._cache['id'][first_species.id] = species
-        self._cache['name'][first_species.name.lower()] = species
+        self._entries[first_species.id] = species
+        self._entries.move_to_end(first_species.id)
+        self._names[name_key(first_species.name)] = first_species.id
+        for form in species:
+            if form:
+                self._forms[name_key('%s (%s)' % (first_species.name, form))] = (first_species.id, form)
+        self._trim()
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self._trim()
+
+    def _trim(self):
+        while len(self._entries) > max(self.maxsize, 1):
+            _, evicted = self._entries.popitem(last=False)
+            first_species = list(evicted.values())[0]
+            del self._names[name_key(first_species.name)]
+            for form in evicted:
+                self._forms.pop(name_key('%s (%s)' % (first_species.name, form)), None)
+            self.evictions += 1
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._entries), self.load_time)
 
 
 _cache = _SpeciesCache()
 
 
+class _SpeciesIndex(object):
+    """
+    A complete in-memory copy of the pokedex, built by preload(). Species are
+    indexed by id and by the name_key() of their name and 'Name (Form)'
+    string, so that lookups never need to query the database.
+    """
+
+    def __init__(self, rows):
+        self._index = {'id': {}, 'name': {}}
+        self.forms: dict[str, Species] = {}
+        for row in rows:
+            species = _build_species(row)
+            species_forms = self._index['id'].setdefault(species.id, {})
+            species_forms[species.form.lower()] = species
+            self._index['name'][name_key(species.name)] = species_forms
+            if species.form:
+                self.forms[name_key('%s (%s)' % (species.name, species.form))] = species
+
+    def get(self, field, value) -> dict[str, Species]:
+        return self._index[field].get(value)
+
+    def all(self) -> list[dict[str, Species]]:
+        return list(self._index['id'].values())
+
+
+_index: _SpeciesIndex | None = None
+
+YIELD_STATS = tuple(EvSet.STATS) + ('total',)
+
+
+def _yield_of(species: Species, stat: str) -> int:
+    if stat == 'total':
+        return sum(getattr(species.evs, name) for name in EvSet.STATS)
+    return getattr(species.evs, stat)
+
+
+class _YieldIndex(object):
+    """
+    A reverse index from EV yields to species. For every stat and for the
+    total, the species are kept sorted by yield, most first, so a range of
+    yields is a slice found by bisection. Species are also grouped by the set
+    of stats they yield in, kept as a bit mask over EvSet.STATS.
+    """
+
+    def __init__(self, species_list: list[Species]):
+        self.species = species_list
+        self._order: dict[str, list[int]] = {}
+        self._yields: dict[str, list[int]] = {}
+        for stat in YIELD_STATS:
+            order = sorted(range(len(species_list)), key=lambda position: -_yield_of(species_list[position], stat))
+            self._order[stat] = order
+            # Negated, so the list is ascending for bisect.
+            self._yields[stat] = [-_yield_of(species_list[position], stat) for position in order]
+        self._masks: dict[int, list[int]] = {}
+        for position, species in enumerate(species_list):
+            self._masks.setdefault(_stat_mask(species.evs.to_dict()), []).append(position)
+
+    def range(self, stat, minimum=None, maximum=None) -> list[int]:
+        """Positions of the species yielding between minimum and maximum in stat, most first."""
+        yields = self._yields[stat]
+        start = 0 if maximum is None else bisect.bisect_left(yields, -maximum)
+        end = len(yields) if minimum is None else bisect.bisect_right(yields, -minimum)
+        return self._order[stat][start:end]
+
+    def only(self, stats) -> set[int]:
+        """Positions of the species that yield in none but the given stats."""
+        allowed = _stat_mask({stat: 1 for stat in stats})
+        positions = set()
+        for mask, mask_positions in self._masks.items():
+            if mask & ~allowed == 0:
+                positions.update(mask_positions)
+        return positions
+
+
+def _stat_mask(amounts: dict) -> int:
+    mask = 0
+    for bit, stat in enumerate(EvSet.STATS):
+        if amounts.get(stat, 0) > 0:
+            mask |= 1 << bit
+    return mask
+
+
+_yield_index: _YieldIndex | None = None
+
+# Close match indexes over species names and lower case form names, built on first use.
+_fuzzy_names: FuzzyIndex | None = None
+_fuzzy_forms: FuzzyIndex | None = None
+
+
 class NoSuchSpecies(Exception):
     """Raised when a search for a Pokemon species fails."""
 
@@ -52,9 +242,9 @@ class NoSuchSpecies(Exception):
 class AmbiguousSpecies(NoSuchSpecies):
     """Raised when several matches are found for a Pokemon name search."""
 
-    def __init__(self, identifier, matches):
+    def __init__(self, identifier, matches: list[Species]):
         super(AmbiguousSpecies, self).__init__(identifier)
-        self.matches = [list(fetch_by_name(match).values())[0] for match in matches]
+        self.matches = matches
 
 
 class AmbiguousForm(NoSuchSpecies):
@@ -66,62 +256,243 @@ class AmbiguousForm(NoSuchSpecies):
         self.has_queried_form = query_includes_form
 
 
-def _name_list():
-    if _cache.names is None:
-        _cache.names = [row[0] for row in _connection.execute('SELECT name FROM pokemon')]
-    return _cache.names
+def _build_species(row) -> Species:
+    evs = EvSet(hp=row['ev_hp'],
+                attack=row['ev_attack'],
+                defense=row['ev_defense'],
+                special_attack=row['ev_special_attack'],
+                special_defense=row['ev_special_defense'],
+                speed=row['ev_speed'])
+    return Species(id=row['id'], name=row['name'], form=row['form'], evs=evs)
+
+
+def _group_rows(rows) -> dict[int, dict[str, Species]]:
+    # Group the rows by species, keeping the forms in database order.
+    grouped: dict[int, dict[str, Species]] = {}
+    for row in rows:
+        grouped.setdefault(row['id'], {})[row['form'].lower()] = _build_species(row)
+    return grouped
+
+
+def _all_species() -> list[dict[str, Species]]:
+    if _index is not None:
+        return _index.all()
+    if _snapshot is not None:
+        rows = _snapshot.all_rows()
+    else:
+        rows = _connect().execute(_SELECT_SPECIES + ' ORDER BY p.id, s.rowid')
+    return list(_group_rows(rows).values())
+
+
+def _build_fuzzy_indexes():
+    global _fuzzy_names, _fuzzy_forms
+    _fuzzy_names = FuzzyIndex()
+    _fuzzy_forms = FuzzyIndex()
+    for species_forms in _all_species():
+        first_species = list(species_forms.values())[0]
+        _fuzzy_names.add(first_species.name, first_species)
+        for species in species_forms.values():
+            if species.form:
+                _fuzzy_forms.add(species.form.lower(), species)
+
+
+def close_matches(name: str, n=3) -> list[Species]:
+    """
+    Find the species whose names are closest to a misspelt name, best match
+    first.
+    """
+    if _fuzzy_names is None:
+        _build_fuzzy_indexes()
+    return [species for _, species in _fuzzy_names.get_close_matches(name, n)]
+
+
+def _close_forms(form: str, species_id: int) -> list[Species]:
+    if _fuzzy_forms is None:
+        _build_fuzzy_indexes()
+    matches = _fuzzy_forms.get_close_matches(form.lower(), n=len(_fuzzy_forms))
+    return [species for _, species in matches if species.id == species_id]
+
 
+def _load_rows(field, values: list) -> list:
+    """
+    Load the species rows for the given ids or name keys, from the
+    snapshot when it is up to date and from the database otherwise.
+    """
+    start_time = time.perf_counter()
+    if _snapshot is not None:
+        load = _snapshot.rows_for_id if field == 'id' else _snapshot.rows_for_name
+        rows = [row for value in values for row in load(value)]
+    else:
+        rows = []
+        for start in range(0, len(values), _MAX_QUERY_PARAMETERS):
+            chunk = values[start:start + _MAX_QUERY_PARAMETERS]
+            rows.extend(_connect().execute(_statement(field, len(chunk)), chunk))
+    _cache.load_time += time.perf_counter() - start_time
+    return rows
+
+
+def _fetch(field, value) -> dict[str, Species]:
+    # When the whole pokedex is preloaded there is no need to query at all.
+    if _index is not None:
+        species_forms = _index.get(field, value)
+        if species_forms is None:
+            raise NoSuchSpecies(value)
+        return species_forms
 
-def _fetch(field, value, sql: str) -> dict[str, Species]:
     # Attempt to retrieve species from the cache.
-    if _cache.contains(field, value):
-        return _cache.get(field, value)
+    species_forms = _cache.get(field, value)
+    if species_forms is not None:
+        return species_forms
 
     # On cache failure, query the database given the provided data.
-    rows = _connection.execute(sql, (value,)).fetchall()
+    rows = _load_rows(field, [value])
     if len(rows) == 0:
         raise NoSuchSpecies(value)
     species_forms: dict[str, Species] = {}
     for row in rows:
         # Build the Species object from the returned data.
-        evs = EvSet(hp=row['ev_hp'],
-                    attack=row['ev_attack'],
-                    defense=row['ev_defense'],
-                    special_attack=row['ev_special_attack'],
-                    special_defense=row['ev_special_defense'],
-                    speed=row['ev_speed'])
-        species = Species(id=row['id'], name=row['name'], form=row['form'], evs=evs)
-
+        species = _build_species(row)
         species_forms[row['form'].lower()] = species
     _cache.add(species_forms)
 
     return species_forms
 
 
+def _fetch_many(field, values) -> dict:
+    """
+    Fetch several species at once, querying the database only for the values
+    that are not cached yet. Values without a match are left out of the result.
+    """
+    if _index is not None:
+        indexed = {value: _index.get(field, value) for value in values}
+        return {value: species_forms for value, species_forms in indexed.items() if species_forms is not None}
+
+    found = {}
+    missing = []
+    for value in dict.fromkeys(values):
+        species_forms = _cache.get(field, value)
+        if species_forms is not None:
+            found[value] = species_forms
+        else:
+            missing.append(value)
+
+    for species_forms in _group_rows(_load_rows(field, missing)).values():
+        _cache.add(species_forms)
+        first_species = list(species_forms.values())[0]
+        found[first_species.id if field == 'id' else name_key(first_species.name)] = species_forms
+
+    return found
+
+
 def fetch_by_id(species_id: int) -> dict[str, Species]:
     """
     Fetch a list of Species object from the pokedex by it's pokedex id. NoSuchSpecies
     will be raised if no match was found.
     """
-    return _fetch('id', species_id,
-                  '''SELECT p.id AS id, name, ev_hp, ev_attack, ev_defense,
-                     ev_special_attack, ev_special_defense, ev_speed, form
-                     FROM pokemon AS p
-                     JOIN stats AS s ON p.id = s.pokemon_id
-                     WHERE p.id = ?''')
+    return _fetch('id', species_id)
 
 
 def fetch_by_name(name: str) -> dict[str, Species]:
     """
     Fetch a list of Species object from the pokedex by it's name. The fetch is case
-    insensitive. NoSuchSpecies will be raised if no match was found.
+    and accent insensitive. NoSuchSpecies will be raised if no match was found.
     """
-    return _fetch('name', name.lower(),
-                  '''SELECT p.id AS id, name, ev_hp, ev_attack, ev_defense,
-                     ev_special_attack, ev_special_defense, ev_speed, form
-                     FROM pokemon AS p
-                     JOIN stats AS s ON p.id = s.pokemon_id
-                     WHERE lower(name) = ?''')
+    return _fetch('name', name_key(name))
+
+
+def fetch_many(species_ids) -> dict[int, dict[str, Species]]:
+    """
+    Fetch the Species for several pokedex ids with a single query, keyed by id.
+    Ids without a match are left out of the result.
+    """
+    return _fetch_many('id', [int(species_id) for species_id in species_ids])
+
+
+def fetch_many_by_name(names) -> dict[str, dict[str, Species]]:
+    """
+    Fetch the Species for several names with a single query, keyed by
+    name_key(). Names without a match are left out of the result.
+    """
+    return _fetch_many('name', [name_key(name) for name in names])
+
+
+def all_species() -> list[Species]:
+    """Every species and form in the pokedex, ordered by pokedex id."""
+    return [species for species_forms in _all_species() for species in species_forms.values()]
+
+
+def _yields() -> _YieldIndex:
+    global _yield_index
+    if _yield_index is None:
+        _yield_index = _YieldIndex(all_species())
+    return _yield_index
+
+
+def _check_stats(stats):
+    for stat in stats:
+        if stat not in YIELD_STATS:
+            raise ValueError("Unknown stat '%s'" % stat)
+
+
+def top_yielders(stat='total', n: int | None = 10) -> list[Species]:
+    """
+    The species and forms giving the most EVs in a stat, or in total, most
+    first. Species yielding nothing in the stat are left out.
+    """
+    _check_stats([stat])
+    positions = _yields().range(stat, minimum=1)
+    return [_yields().species[position] for position in positions[:n]]
+
+
+def find_by_yield(minimum: dict[str, int] = None, maximum: dict[str, int] = None, only=None) -> list[Species]:
+    """
+    Find the species and forms yielding at least minimum[stat] and at most
+    maximum[stat] EVs for each stat given, where stat may also be 'total'. If
+    only is given, species yielding in any other stat are left out. Species
+    are ordered by their yield in the first stat of minimum, most first, or
+    by total yield.
+    """
+    minimum = minimum or {}
+    maximum = maximum or {}
+    _check_stats(list(minimum) + list(maximum) + list(only or ()))
+    index = _yields()
+    stats = list(dict.fromkeys(list(minimum) + list(maximum)))
+    ranges = [index.range(stat, minimum.get(stat), maximum.get(stat)) for stat in stats]
+    ordered = ranges[0] if ranges else index.range('total')
+    filters = [set(positions) for positions in ranges[1:]]
+    if only is not None:
+        filters.append(index.only(only))
+    filters.sort(key=len)
+    return [index.species[position] for position in ordered
+            if all(position in positions for positions in filters)]
+
+
+def configure_cache(maxsize: int):
+    """Change the number of species kept in the cache, evicting any excess."""
+    _cache.resize(maxsize)
+
+
+def cache_info() -> CacheInfo:
+    """
+    Report species cache statistics: hits, misses, evictions, the size bound,
+    the number of cached species and the seconds spent loading species rows.
+    Lookups served by preload() do not use the cache.
+    """
+    return _cache.info()
+
+
+def preload():
+    """
+    Load every species from the database with a single query and serve all
+    further lookups from memory. Calling it again has no effect.
+    """
+    global _index
+    if _index is None:
+        if _snapshot is not None:
+            rows = _snapshot.all_rows()
+        else:
+            rows = _connect().execute(_SELECT_SPECIES + ' ORDER BY p.id, s.rowid')
+        _index = _SpeciesIndex(rows)
 
 
 def search(search_query: str | int):
@@ -134,6 +505,18 @@ def search(search_query: str | int):
     Will raise NoSuchSpecies if no match is found, AmbiguousSpecies if
     there are close matches, AmbiguousForm if there are multiple forms if a valid one is not specified.
     """
+    with timings.instance.phase('species_lookup'):
+        return _search(search_query)
+
+
+def _search(search_query: str | int):
+    query_key = name_key(search_query)
+    if _index is not None and query_key in _index.forms:
+        return _index.forms[query_key]
+    cached_form = _cache.get_form(query_key)
+    if cached_form is not None:
+        return cached_form
+
     original_query = search_query
     form = ''
     if search_query.find('(') > -1:
@@ -150,7 +533,7 @@ def search(search_query: str | int):
             species_list = fetch_by_name(search_query)
         except NoSuchSpecies as e:
             # No exact match was found, try a fuzzy search.
-            matches = difflib.get_close_matches(search_query, _name_list())
+            matches = close_matches(search_query)
             if len(matches) == 0:
                 raise e
             else:
@@ -160,8 +543,12 @@ def search(search_query: str | int):
         return list(species_list.values())[0]
     if form.lower() in species_list:
         return species_list[form.lower()]
+    suggestions = list(species_list.values())
+    if form:
+        # Only suggest the forms close to the one that was asked for, if any.
+        suggestions = _close_forms(form, suggestions[0].id) or suggestions
     form_list = []
-    for form_id, species in species_list.items():
+    for species in suggestions:
         form_list.append(search_query + ' (' + species.form + ')')
 
     raise AmbiguousForm(original_query, form != '', form_list)
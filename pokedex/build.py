@@ -0,0 +1,79 @@
+"""
+Build step for the pokedex data files. Run from the repository root after
+regenerating pokedex.db from pokedex.sql:
+
+    python -m pokedex.build [DATABASE [SNAPSHOT]]
+
+The database is migrated in place first: the normalised name_key column is
+filled in and the lookup indexes are created, then the query plans of the
+lookups are checked to use them. The snapshot is written next to the
+database with a .snapshot extension unless another path is given, so
+building from another database never replaces the shipped snapshot.
+"""
+
+import os
+import sqlite3
+import sys
+
+import pokedex
+from pokedex import snapshot
+from pokedex.names import name_key
+
+_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS pokemon_name_key ON pokemon (name_key)',
+    'CREATE INDEX IF NOT EXISTS stats_pokemon_id ON stats (pokemon_id)',
+]
+
+# Lookups that must be answered through an index rather than a table scan.
+_LOOKUPS = {
+    'name': pokedex._SELECT_SPECIES + ' WHERE p.name_key = ? ORDER BY s.rowid',
+    'names': pokedex._SELECT_SPECIES + ' WHERE p.name_key IN (?, ?) ORDER BY s.rowid',
+    'id': pokedex._SELECT_SPECIES + ' WHERE p.id = ? ORDER BY s.rowid',
+}
+
+
+def migrate(db_file) -> int:
+    """Add and fill the name_key column and create the lookup indexes. Returns the number of names keyed."""
+    connection = sqlite3.connect(db_file)
+    with connection:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(pokemon)')]
+        if 'name_key' not in columns:
+            connection.execute('ALTER TABLE pokemon ADD COLUMN name_key TEXT')
+        names = connection.execute('SELECT id, name FROM pokemon').fetchall()
+        connection.executemany('UPDATE pokemon SET name_key = ? WHERE id = ?',
+                               [(name_key(name), species_id) for species_id, name in names])
+        for statement in _INDEXES:
+            connection.execute(statement)
+        connection.execute('ANALYZE')
+    connection.execute('VACUUM')
+    connection.close()
+    return len(names)
+
+
+def check_query_plans(db_file) -> list[str]:
+    """Return the lookups whose query plan scans a table instead of using an index."""
+    connection = sqlite3.connect(db_file)
+    scans = []
+    for lookup, sql in _LOOKUPS.items():
+        parameters = [None] * sql.count('?')
+        try:
+            plan = connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except sqlite3.OperationalError as e:
+            scans.append('%s: %s' % (lookup, e))
+            continue
+        for row in plan:
+            if row[3].startswith('SCAN'):
+                scans.append('%s: %s' % (lookup, row[3]))
+    connection.close()
+    return scans
+
+
+if __name__ == '__main__':
+    db_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'pokedex.db')
+    print('Keyed %d species names in %s' % (migrate(db_file), db_file))
+    scans = check_query_plans(db_file)
+    if scans:
+        sys.exit('Species lookups do not use an index:\n  ' + '\n  '.join(scans))
+    snapshot_file = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(db_file)[0] + '.snapshot'
+    count = snapshot.build(db_file, snapshot_file)
+    print('Wrote %d species records to %s' % (count, snapshot_file))
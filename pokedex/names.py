@@ -0,0 +1,14 @@
+"""
+Normalised lookup keys for species names.
+"""
+
+import unicodedata
+
+
+def name_key(name: str) -> str:
+    """
+    The key a species name is looked up by: case folded with accents removed,
+    so that 'Flabébé', 'FLABEBE' and 'flabebe' share a key.
+    """
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
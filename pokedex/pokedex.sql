@@ -3,6 +3,8 @@
 -- http://bulbapedia.bulbagarden.net/wiki/List_of_Pok%C3%A9mon_by_effort_value_yield
 --
 -- Generate with: sqlite3 pokedex.db < pokedex.sql
+-- Then fill in the name keys and rebuild the binary snapshot with:
+-- python -m pokedex.build
 --
 
 CREATE TABLE "pokemon" (
@@ -661,6 +663,11 @@ INSERT INTO "pokemon" VALUES (647, "Keldeo");
 INSERT INTO "pokemon" VALUES (648, "Meloetta");
 INSERT INTO "pokemon" VALUES (649, "Genesect");
 
+-- The case and accent folded name species are looked up by, filled in by
+-- python -m pokedex.build. Until then lookups compute it from the name.
+ALTER TABLE "pokemon" ADD COLUMN "name_key" TEXT;
+CREATE INDEX pokemon_name_key ON pokemon (name_key);
+
 
 CREATE TABLE "stats" (
   "pokemon_id" INTEGER REFERENCES pokemon(id) ON DELETE CASCADE NOT NULL,
@@ -1333,3 +1340,5 @@ INSERT INTO "stats" ("pokemon_id", "ev_hp", "ev_attack", "ev_defense", "ev_speci
 INSERT INTO "stats" ("pokemon_id", "ev_hp", "ev_attack", "ev_defense", "ev_special_attack", "ev_special_defense", "ev_speed", "form") VALUES (648, 0, 0, 0, 1, 1, 1, "Aria Forme");
 INSERT INTO "stats" ("pokemon_id", "ev_hp", "ev_attack", "ev_defense", "ev_special_attack", "ev_special_defense", "ev_speed", "form") VALUES (648, 0, 1, 1, 0, 0, 1, "Pirouette Forme");
 INSERT INTO "stats" ("pokemon_id", "ev_hp", "ev_attack", "ev_defense", "ev_special_attack", "ev_special_defense", "ev_speed", "form") VALUES (649, 0, 1, 0, 1, 0, 1, "");
+
+CREATE INDEX stats_pokemon_id ON stats (pokemon_id);
@@ -0,0 +1,148 @@
+"""
+A compact, versioned binary copy of the pokedex database that can be memory
+mapped at start up instead of opening the SQLite database.
+
+Layout (all integers little-endian):
+
+    header   magic, version, record count, id table size, CRC-32 of the
+             source database, CRC-32 of everything after the header
+    id table for every pokedex id: index of its first record, record count
+    records  fixed width: id, six EV bytes, name offset/length, form
+             offset/length into the string blob
+    blob     UTF-8 encoded names and forms
+
+Rebuild it after changing pokedex.db with:
+
+    python -m pokedex.build
+"""
+
+import mmap
+import os
+import sqlite3
+import struct
+import zlib
+
+from pokedex.names import name_key
+
+SNAPSHOT_FILE = os.path.join(os.path.dirname(__file__), 'pokedex.snapshot')
+
+MAGIC = b'EVDX'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHIIII')
+_ID_ENTRY = struct.Struct('<HH')
+_RECORD = struct.Struct('<H6BIHIH')
+
+_EV_COLUMNS = ('ev_hp', 'ev_attack', 'ev_defense', 'ev_special_attack', 'ev_special_defense', 'ev_speed')
+
+
+def _source_checksum(db_file) -> int:
+    with open(db_file, 'rb') as fp:
+        return zlib.crc32(fp.read())
+
+
+class Snapshot(object):
+    """
+    Read access to a memory mapped snapshot file. Rows are returned as dicts
+    with the same keys as the pokedex database query.
+    """
+
+    def __init__(self, buffer, record_count, id_count):
+        self._buffer = buffer
+        self._record_count = record_count
+        self._id_count = id_count
+        self._records_offset = _HEADER.size + id_count * _ID_ENTRY.size
+        self._blob_offset = self._records_offset + record_count * _RECORD.size
+        self._name_ids = None
+
+    def _string(self, offset, length) -> str:
+        start = self._blob_offset + offset
+        return self._buffer[start:start + length].decode('utf-8')
+
+    def _row(self, index) -> dict:
+        fields = _RECORD.unpack_from(self._buffer, self._records_offset + index * _RECORD.size)
+        row = {'id': fields[0], 'name': self._string(fields[7], fields[8]), 'form': self._string(fields[9], fields[10])}
+        row.update(zip(_EV_COLUMNS, fields[1:7]))
+        return row
+
+    def rows_for_id(self, species_id: int) -> list[dict]:
+        if not 0 <= species_id < self._id_count:
+            return []
+        first, count = _ID_ENTRY.unpack_from(self._buffer, _HEADER.size + species_id * _ID_ENTRY.size)
+        return [self._row(index) for index in range(first, first + count)]
+
+    def rows_for_name(self, name: str) -> list[dict]:
+        if self._name_ids is None:
+            self._name_ids = {name_key(row['name']): row['id'] for row in self.all_rows()}
+        species_id = self._name_ids.get(name_key(name))
+        return [] if species_id is None else self.rows_for_id(species_id)
+
+    def all_rows(self) -> list[dict]:
+        return [self._row(index) for index in range(self._record_count)]
+
+
+def load(db_file, snapshot_file=SNAPSHOT_FILE) -> Snapshot | None:
+    """
+    Map the snapshot file into memory. Returns None if the snapshot is missing,
+    was built by a different version, is corrupt or was built from a database
+    that has changed since, so that the caller can fall back to SQLite.
+    """
+    try:
+        with open(snapshot_file, 'rb') as fp:
+            buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(buffer) < _HEADER.size:
+        return None
+    magic, version, _, record_count, id_count, source_checksum, payload_checksum = _HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        return None
+    try:
+        if source_checksum != _source_checksum(db_file):
+            return None
+    except OSError:
+        return None
+    if payload_checksum != zlib.crc32(buffer[_HEADER.size:]):
+        return None
+    return Snapshot(buffer, record_count, id_count)
+
+
+def build(db_file, snapshot_file=SNAPSHOT_FILE):
+    """Compile the pokedex database into a snapshot file."""
+    connection = sqlite3.connect(db_file)
+    connection.row_factory = sqlite3.Row
+    rows = connection.execute('''SELECT p.id AS id, name, ev_hp, ev_attack, ev_defense,
+                                 ev_special_attack, ev_special_defense, ev_speed, form
+                                 FROM pokemon AS p
+                                 JOIN stats AS s ON p.id = s.pokemon_id
+                                 ORDER BY p.id, s.rowid''').fetchall()
+    connection.close()
+
+    blob = bytearray()
+    strings = {}
+
+    def add_string(value):
+        if value not in strings:
+            strings[value] = (len(blob), len(value.encode('utf-8')))
+            blob.extend(value.encode('utf-8'))
+        return strings[value]
+
+    id_count = rows[-1]['id'] + 1 if rows else 0
+    id_table = [[0, 0] for _ in range(id_count)]
+    records = bytearray()
+    for index, row in enumerate(rows):
+        entry = id_table[row['id']]
+        if entry[1] == 0:
+            entry[0] = index
+        entry[1] += 1
+        name_offset, name_length = add_string(row['name'])
+        form_offset, form_length = add_string(row['form'])
+        records.extend(_RECORD.pack(row['id'], *(row[column] for column in _EV_COLUMNS),
+                                    name_offset, name_length, form_offset, form_length))
+
+    payload = b''.join(_ID_ENTRY.pack(*entry) for entry in id_table) + bytes(records) + bytes(blob)
+    header = _HEADER.pack(MAGIC, VERSION, 0, len(rows), id_count, _source_checksum(db_file), zlib.crc32(payload))
+    with open(snapshot_file, 'wb') as fp:
+        fp.write(header + payload)
+    return len(rows)
+
@@ -1,60 +1,177 @@
-import difflib
-
 import config
+from fuzzy import FuzzyIndex
+
+
+# Held items as (yield multiplier, stat given Power item effort).
+_ITEM_RULES = {
+    'Macho Brace': (2, None),
+    'Power Weight': (1, 'hp'),
+    'Power Bracer': (1, 'attack'),
+    'Power Belt': (1, 'defense'),
+    'Power Lens': (1, 'special_attack'),
+    'Power Band': (1, 'special_defense'),
+    'Power Anklet': (1, 'speed'),
+}
+
+# Consumables as (EV multiplier, stat, amount added), where an amount of None
+# lowers the stat like a berry.
+_CONSUMABLE_RULES = {
+    'HP Up': (1, 'hp', 10),
+    'Protein': (1, 'attack', 10),
+    'Iron': (1, 'defense', 10),
+    'Calcium': (1, 'special_attack', 10),
+    'Zinc': (1, 'special_defense', 10),
+    'Carbos': (1, 'speed', 10),
+    'Health Feather': (1, 'hp', 1),
+    'Muscle Feather': (1, 'attack', 1),
+    'Resist Feather': (1, 'defense', 1),
+    'Genius Feather': (1, 'special_attack', 1),
+    'Clever Feather': (1, 'special_defense', 1),
+    'Swift Feather': (1, 'speed', 1),
+    'Pomeg Berry': (1, 'hp', None),
+    'Kelpsy Berry': (1, 'attack', None),
+    'Qualot Berry': (1, 'defense', None),
+    'Hondew Berry': (1, 'special_attack', None),
+    'Grepa Berry': (1, 'special_defense', None),
+    'Tamato Berry': (1, 'speed', None),
+    'Perilous Soup': (0, None, 0),
+    'Health Mochi': (1, 'hp', 10),
+    'Muscle Mochi': (1, 'attack', 10),
+    'Resist Mochi': (1, 'defense', 10),
+    'Genius Mochi': (1, 'special_attack', 10),
+    'Clever Mochi': (1, 'special_defense', 10),
+    'Swift Mochi': (1, 'speed', 10),
+    'Fresh-Start Mochi': (0, None, 0),
+}
+
+_STAT_NAMES = ('hp', 'attack', 'defense', 'special_attack', 'special_defense', 'speed')
+
+
+class ModifierTables(object):
+    """
+    The held item and consumable rules compiled for one Config into flat
+    modifier vectors, so battle and vitamin modifiers need no config lookups.
+
+    battle maps (item name, has Pokerus) to a (multiplier, addition) pair:
+    one battle adds the species' yield times multiplier plus addition.
+    consumables maps a name to (multiplier, addition, berry stat): the EVs
+    become EVs times multiplier plus addition, and berry stat is the
+    position of the stat a berry lowers, or None.
+    """
+
+    def __init__(self, config_instance):
+        self.power_item_effort = 8 if config_instance.double_power_items_effort() else 4
+        self.berry_cuts_to_100 = config_instance.berry_reduction_cuts_to_100()
+        self.limits = (252 if config_instance.smart_iv_cap() else 255, 510)
+        pokerus_multiplier = 1 if config_instance.ignore_pokerus() else 2
+
+        self.battle: dict[tuple, tuple[int, tuple]] = {}
+        for item, (multiplier, stat) in [(None, (1, None))] + list(_ITEM_RULES.items()):
+            addition = _vector(stat, self.power_item_effort)
+            for pokerus in (False, True):
+                scale = pokerus_multiplier if pokerus else 1
+                self.battle[item, pokerus] = (multiplier * scale, tuple(amount * scale for amount in addition))
+
+        self.consumables: dict[str, tuple[int, tuple, int | None]] = {}
+        for name, (multiplier, stat, amount) in _CONSUMABLE_RULES.items():
+            berry_stat = _STAT_NAMES.index(stat) if amount is None else None
+            self.consumables[name] = (multiplier, _vector(stat, amount or 0), berry_stat)
+
+    def berry_reduction(self, current_stat):
+        return current_stat - 100 if self.berry_cuts_to_100 and current_stat > 100 else 10
+
+    def battle_modifier(self, species_evs, item, pokerus, number=1):
+        """The EVs a Pokemon holding item gains from number battles against a species yielding species_evs."""
+        multiplier, addition = self.battle[item, pokerus]
+        return EvSet((species_evs.hp * multiplier + addition[0]) * number,
+                     (species_evs.attack * multiplier + addition[1]) * number,
+                     (species_evs.defense * multiplier + addition[2]) * number,
+                     (species_evs.special_attack * multiplier + addition[3]) * number,
+                     (species_evs.special_defense * multiplier + addition[4]) * number,
+                     (species_evs.speed * multiplier + addition[5]) * number)
+
+    def consumable_change(self, name, evs):
+        """The change in evs from using the consumable once."""
+        multiplier, addition, berry_stat = self.consumables[name]
+        scale = multiplier - 1
+        values = [evs.hp, evs.attack, evs.defense, evs.special_attack, evs.special_defense, evs.speed]
+        change = [value * scale + amount for value, amount in zip(values, addition)]
+        if berry_stat is not None:
+            change[berry_stat] -= self.berry_reduction(values[berry_stat])
+        return EvSet(*change)
+
+
+def _vector(stat, amount):
+    return tuple(amount if name == stat else 0 for name in _STAT_NAMES)
+
+
+_tables: ModifierTables | None = None
+
+
+def configure_modifiers(config_instance):
+    """
+    Compile the modifier tables for a Config. Call it whenever the
+    generation or game changes; until then the tables for config.instance
+    are built on first use.
+    """
+    global _tables
+    _tables = ModifierTables(config_instance)
+
+
+def modifier_tables() -> ModifierTables:
+    if _tables is None:
+        configure_modifiers(config.instance)
+    return _tables
 
 
 def get_power_item_effort():
-    return 8 if config.instance.double_power_items_effort() else 4
+    return modifier_tables().power_item_effort
 
 
 def get_berry_reduction_amount(current_stat):
-    return current_stat - 100 if config.instance.berry_reduction_cuts_to_100() and current_stat > 100 else 10
+    return modifier_tables().berry_reduction(current_stat)
 
 
-ITEMS = {
-    'Macho Brace': lambda evs: evs * 2,
-    'Power Weight': lambda evs: evs + EvSet(hp=get_power_item_effort()),
-    'Power Bracer': lambda evs: evs + EvSet(attack=get_power_item_effort()),
-    'Power Belt': lambda evs: evs + EvSet(defense=get_power_item_effort()),
-    'Power Lens': lambda evs: evs + EvSet(special_attack=get_power_item_effort()),
-    'Power Band': lambda evs: evs + EvSet(special_defense=get_power_item_effort()),
-    'Power Anklet': lambda evs: evs + EvSet(speed=get_power_item_effort()),
-}
+def _item_rule(name):
+    def apply(evs):
+        multiplier, addition = modifier_tables().battle[name, False]
+        return evs * multiplier + EvSet(*addition)
+    return apply
 
-VITAMINS = {
-    'HP Up': lambda evs: evs + EvSet(hp=10),
-    'Protein': lambda evs: evs + EvSet(attack=10),
-    'Iron': lambda evs: evs + EvSet(defense=10),
-    'Calcium': lambda evs: evs + EvSet(special_attack=10),
-    'Zinc': lambda evs: evs + EvSet(special_defense=10),
-    'Carbos': lambda evs: evs + EvSet(speed=10),
-    'Health Feather': lambda evs: evs + EvSet(hp=1),
-    'Muscle Feather': lambda evs: evs + EvSet(attack=1),
-    'Resist Feather': lambda evs: evs + EvSet(defense=1),
-    'Genius Feather': lambda evs: evs + EvSet(special_attack=1),
-    'Clever Feather': lambda evs: evs + EvSet(special_defense=1),
-    'Swift Feather': lambda evs: evs + EvSet(speed=1),
-    'Pomeg Berry': lambda evs: evs - EvSet(hp=get_berry_reduction_amount(evs.hp)),
-    'Kelpsy Berry': lambda evs: evs - EvSet(attack=get_berry_reduction_amount(evs.attack)),
-    'Qualot Berry': lambda evs: evs - EvSet(defense=get_berry_reduction_amount(evs.defense)),
-    'Hondew Berry': lambda evs: evs - EvSet(special_attack=get_berry_reduction_amount(evs.special_attack)),
-    'Grepa Berry': lambda evs: evs - EvSet(special_defense=get_berry_reduction_amount(evs.special_defense)),
-    'Tamato Berry': lambda evs: evs - EvSet(speed=get_berry_reduction_amount(evs.speed)),
-    'Perilous Soup': lambda evs: evs * 0,
-    'Health Mochi': lambda evs: evs + EvSet(hp=10),
-    'Muscle Mochi': lambda evs: evs + EvSet(attack=10),
-    'Resist Mochi': lambda evs: evs + EvSet(defense=10),
-    'Genius Mochi': lambda evs: evs + EvSet(special_attack=10),
-    'Clever Mochi': lambda evs: evs + EvSet(special_defense=10),
-    'Swift Mochi': lambda evs: evs + EvSet(speed=10),
-    'Fresh-Start Mochi': lambda evs: evs * 0,
-}
+
+def _consumable_rule(name):
+    return lambda evs: evs + modifier_tables().consumable_change(name, evs)
+
+
+# The rules as functions from EVs to EVs, for callers applying them one at a time.
+ITEMS = {name: _item_rule(name) for name in _ITEM_RULES}
+VITAMINS = {name: _consumable_rule(name) for name in _CONSUMABLE_RULES}
+
+_ITEM_NAMES = FuzzyIndex(ITEMS)
+_VITAMIN_NAMES = FuzzyIndex(VITAMINS)
+
+
+def resolve_item_name(item: str) -> str:
+    """Return the name of the held item closest to item."""
+    if item in ITEMS:
+        return item
+    matches = _ITEM_NAMES.get_close_matches(item)
+    if len(matches) == 0:
+        raise ValueError("Invalid item '%s'" % item)
+    elif len(matches) == 1:
+        return matches[0][0]
+    else:
+        raise ValueError("Ambiguous item '%s'" % item)
 
 
 class EvSet(object):
     STATS = ['hp', 'attack', 'defense', 'special_attack', 'special_defense', 'speed']
     LABELS = ['HP', 'Attack', 'Defense', 'Special Attack', 'Special Defense', 'Speed']
 
+    # Six plain slots instead of an instance __dict__, as every tracked
+    # Pokemon holds two EvSets. Arithmetic is unrolled over the stats.
+    __slots__ = ('hp', 'attack', 'defense', 'special_attack', 'special_defense', 'speed')
+
     @staticmethod
     def label(stat):
         return EvSet.LABELS[EvSet.STATS.index(stat)]
@@ -69,8 +186,12 @@ class EvSet(object):
         self.speed = int(speed)
 
     def __iadd__(self, other):
-        for stat in EvSet.STATS:
-            self.__dict__[stat] += other.__dict__[stat]
+        self.hp += other.hp
+        self.attack += other.attack
+        self.defense += other.defense
+        self.special_attack += other.special_attack
+        self.special_defense += other.special_defense
+        self.speed += other.speed
         return self
 
     def __add__(self, other):
@@ -79,8 +200,12 @@ class EvSet(object):
         return evs
 
     def __isub__(self, other):
-        for stat in EvSet.STATS:
-            self.__dict__[stat] -= other.__dict__[stat]
+        self.hp -= other.hp
+        self.attack -= other.attack
+        self.defense -= other.defense
+        self.special_attack -= other.special_attack
+        self.special_defense -= other.special_defense
+        self.speed -= other.speed
         return self
 
     def __sub__(self, other):
@@ -89,8 +214,12 @@ class EvSet(object):
         return evs
 
     def __imul__(self, integer):
-        for stat in EvSet.STATS:
-            self.__dict__[stat] *= integer
+        self.hp *= integer
+        self.attack *= integer
+        self.defense *= integer
+        self.special_attack *= integer
+        self.special_defense *= integer
+        self.speed *= integer
         return self
 
     def __mul__(self, integer):
@@ -98,21 +227,40 @@ class EvSet(object):
         evs *= integer
         return evs
 
-    def capped_add(self, other):
-        for stat in EvSet.STATS:
-            add_amount = other.__dict__[stat]
-            total = self.total_effort()
-            total_max = self.max_total_effort()
+    def capped_add(self, other, limits=None):
+        """
+        Add other to this EvSet, keeping each stat between zero and the stat
+        cap and the total within the total cap. Stats are applied in order,
+        so earlier stats take precedence for the remaining total. limits is
+        a (stat cap, total cap) pair from effort_limits(), resolved here if
+        not given.
+        """
+        stat_max, total_max = EvSet.effort_limits() if limits is None else limits
+        values = [self.hp, self.attack, self.defense, self.special_attack, self.special_defense, self.speed]
+        amounts = (other.hp, other.attack, other.defense, other.special_attack, other.special_defense, other.speed)
+        total = values[0] + values[1] + values[2] + values[3] + values[4] + values[5]
+        for index in range(6):
+            add_amount = amounts[index]
             if total + add_amount > total_max:
                 add_amount = total_max - total
-            stat_amount = self.__dict__[stat]
-            stat_max = self.max_stat_effort()
+            stat_amount = values[index]
             if stat_amount + add_amount > stat_max:
                 add_amount = stat_max - stat_amount
             elif stat_amount + add_amount < 0:
                 add_amount = -stat_amount
+            values[index] = stat_amount + add_amount
+            total += add_amount
+        self.hp, self.attack, self.defense, self.special_attack, self.special_defense, self.speed = values
 
-            self.__dict__[stat] += add_amount
+    @staticmethod
+    def capped_add_all(additions):
+        """
+        Apply capped_add to many (EvSet, modifier) pairs at once, resolving the
+        caps a single time for the whole batch.
+        """
+        limits = EvSet.effort_limits()
+        for evs, modifier in additions:
+            evs.capped_add(modifier, limits)
 
     def __str__(self):
         return self.format()
@@ -143,27 +291,26 @@ class EvSet(object):
         return ', '.join(ev_string)
 
     def clone(self):
-        return EvSet(**self.to_dict())
+        return EvSet(self.hp, self.attack, self.defense, self.special_attack, self.special_defense, self.speed)
 
     def to_dict(self):
-        dict = {}
-        for stat in EvSet.STATS:
-            dict[stat] = self.__dict__[stat]
-        return dict
+        return {'hp': self.hp, 'attack': self.attack, 'defense': self.defense,
+                'special_attack': self.special_attack, 'special_defense': self.special_defense, 'speed': self.speed}
 
     def total_effort(self):
-        total = 0
-        for stat in EvSet.STATS:
-            total += self.__dict__[stat]
-        return total
+        return self.hp + self.attack + self.defense + self.special_attack + self.special_defense + self.speed
 
     @staticmethod
     def max_stat_effort():
-        return 252 if config.instance.smart_iv_cap() else 255
+        return modifier_tables().limits[0]
 
     @staticmethod
     def max_total_effort():
-        return 510
+        return modifier_tables().limits[1]
+
+    @staticmethod
+    def effort_limits():
+        return modifier_tables().limits
 
 
 class Species(object):
@@ -204,7 +351,8 @@ class Pokemon(object):
             item: str = None,
             pokerus: bool = False,
             evs: EvSet = None,
-            target_evs: EvSet = None
+            target_evs: EvSet = None,
+            created: int = None
     ):
         self.id = int(id)
         self.species = species
@@ -217,10 +365,17 @@ class Pokemon(object):
         self.pokerus = pokerus
         self.evs = EvSet() if evs is None else evs
         self.target_evs = EvSet() if target_evs is None else target_evs
+        # When the Pokemon was first tracked, in microseconds. Tells apart
+        # Pokemon that had the same id, as released ids are used again.
+        self.created = created
 
     def get_individual_id(self) -> int:
         return self.id
 
+    def copy(self):
+        return Pokemon(self.id, self.species, self.form, self._name, self._itemName, self.pokerus,
+                       self.evs.clone(), self.target_evs.clone(), self.created)
+
     def delete(self):
         self.id = None
 
@@ -228,18 +383,21 @@ class Pokemon(object):
         return self.species.name if self._name is None else self._name
 
     def set_name(self, name):
-        if name is not None and len(name.strip()) > 0:
+        if name is None:
+            self._name = None
+        elif len(name.strip()) > 0:
             self._name = name.strip()
 
     name = property(get_name, set_name)
 
     def set_item(self, item):
-        if item is not None and item not in ITEMS:
-            raise ValueError("Invalid item '%s'" % item)
+        if item is not None:
+            item = resolve_item_name(item)
         self._item = ITEMS[item] if item is not None else None
         self._itemName = item
 
     item = property(lambda self: self._item, set_item)
+    item_name = property(lambda self: self._itemName)
 
     def set_effort(self, hp=None, attack=None, defense=None, special_attack=None, special_defense=None, speed=None):
         if hp is not None:
@@ -302,27 +460,23 @@ class Pokemon(object):
         These values are altered by pokerus and any item held. The EV
         increment can be multiplied by number to simulate multiple battles.
         """
-        evs = species.evs.clone()
-        if self.item is not None:
-            evs = self.item(evs)
-        if self.pokerus and not config.instance.ignore_pokerus():
-            evs *= 2
-        return evs * number
+        return modifier_tables().battle_modifier(species.evs, self._itemName, bool(self.pokerus), number)
 
     def get_vitamin_ev_modifier(self, vitamin, number=1):
         if vitamin not in VITAMINS:
-            matches = difflib.get_close_matches(vitamin, VITAMINS)
+            matches = _VITAMIN_NAMES.get_close_matches(vitamin)
             if len(matches) == 0:
                 raise ValueError("Invalid vitamin '%s'" % vitamin)
             elif len(matches) == 1:
-                vitamin = matches.pop()
+                vitamin = matches[0][0]
             else:
                 raise ValueError("Ambiguous vitamin '%s'" % vitamin)
-        evs = self.evs.clone()
-        new_evs = VITAMINS[vitamin](evs)
-        return (new_evs - evs) * number
+        return modifier_tables().consumable_change(vitamin, self.evs) * number
 
     def to_dict(self):
-        return {'species': self.species.id, 'name': self._name,
-                'pokerus': self.pokerus, 'item': self._itemName,
-                'evs': self.evs.to_dict(), 'id': self.id, 'target_evs': self.target_evs.to_dict()}
+        record = {'species': self.species.id, 'name': self._name,
+                  'pokerus': self.pokerus, 'item': self._itemName,
+                  'evs': self.evs.to_dict(), 'id': self.id, 'target_evs': self.target_evs.to_dict()}
+        if self.created is not None:
+            record['created'] = self.created
+        return record
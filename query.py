@@ -0,0 +1,222 @@
+"""
+Filtering tracked Pokemon through secondary indexes.
+
+A filter is a short expression:
+
+    species=<species>     Pokemon of a species, e.g. species=pikachu
+    item=<item>           Pokemon holding an item, or item=none
+    pokerus               Pokemon with Pokerus, or pokerus=no for without
+    location=<location>   Pokemon on the team, in the box or in the archive
+    below_target          Pokemon short of a target in any stat, or
+                          below_target=<stat> for one stat
+    evs.<stat><op><n>     Compare effort in a stat, e.g. evs.speed<252
+    remaining.<stat><op><n>
+                          Compare the effort still needed to reach the target
+
+where <stat> is hp, attack, defense, special_attack, special_defense, speed
+or total and <op> is one of < <= > >= = !=.
+"""
+
+import operator
+import re
+
+import pokedex
+from pokemon import ITEMS, EvSet, Pokemon, resolve_item_name
+
+STATS = tuple(EvSet.STATS) + ('total',)
+LOCATIONS = ('team', 'box', 'archive')
+
+_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+_COMPARISON = re.compile(r'^(evs|remaining)\.([a-z_-]+)\s*(<=|>=|==|!=|<|>|=)\s*(\d+)$')
+_ITEM_NAMES = {name.lower(): name for name in ITEMS}
+_YES = ('', 'yes', 'true', '1')
+_NO = ('no', 'false', '0')
+
+
+class InvalidFilter(Exception):
+    """
+    Raised when a query filter can not be parsed.
+    """
+
+    def __init__(self, expression, reason):
+        super(InvalidFilter, self).__init__("Invalid filter '%s': %s" % (expression, reason))
+        self.expression = expression
+        self.reason = reason
+
+
+def _stat(expression, name) -> str:
+    stat = name.lower().replace('-', '_')
+    if stat not in STATS:
+        raise InvalidFilter(expression, "unknown stat '%s'" % name)
+    return stat
+
+
+def _add(index: dict, key, individual_id):
+    index.setdefault(key, set()).add(individual_id)
+
+
+def _discard(index: dict, key, individual_id):
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(individual_id)
+        if not ids:
+            del index[key]
+
+
+class _Keys(object):
+    """The values a Pokemon is indexed under."""
+
+    __slots__ = ('species', 'item', 'pokerus', 'evs', 'remaining')
+
+    def __init__(self, pokemon: Pokemon):
+        self.species = pokemon.species.id
+        self.item = None if pokemon.item_name is None else pokemon.item_name.lower()
+        self.pokerus = bool(pokemon.pokerus)
+        evs = [getattr(pokemon.evs, stat) for stat in EvSet.STATS]
+        targets = [getattr(pokemon.target_evs, stat) for stat in EvSet.STATS]
+        remaining = [max(target - ev, 0) if target > 0 else 0 for ev, target in zip(evs, targets)]
+        self.evs = tuple(evs) + (sum(evs),)
+        self.remaining = tuple(remaining) + (sum(remaining),)
+
+
+class PokemonIndex(object):
+    """
+    Secondary indexes over tracked Pokemon by species, held item, Pokerus,
+    effort per stat and effort remaining to the target per stat. The effort
+    indexes bucket ids by value, so a comparison visits at most a few hundred
+    buckets whatever the number of Pokemon.
+
+    Call update() whenever a Pokemon changes and remove() when it is released.
+    """
+
+    def __init__(self, pokemon=()):
+        self._keys: dict[int, _Keys] = {}
+        self._species: dict[int, set] = {}
+        self._items: dict[str | None, set] = {}
+        self._pokerus: set = set()
+        self._evs: list[dict[int, set]] = [{} for _ in STATS]
+        self._remaining: list[dict[int, set]] = [{} for _ in STATS]
+        for individual in pokemon:
+            self.update(individual)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, pokemon: Pokemon):
+        individual_id = pokemon.get_individual_id()
+        self.remove(individual_id)
+        keys = self._keys[individual_id] = _Keys(pokemon)
+        _add(self._species, keys.species, individual_id)
+        _add(self._items, keys.item, individual_id)
+        if keys.pokerus:
+            self._pokerus.add(individual_id)
+        for position in range(len(STATS)):
+            _add(self._evs[position], keys.evs[position], individual_id)
+            _add(self._remaining[position], keys.remaining[position], individual_id)
+
+    def remove(self, individual_id):
+        keys = self._keys.pop(individual_id, None)
+        if keys is None:
+            return
+        _discard(self._species, keys.species, individual_id)
+        _discard(self._items, keys.item, individual_id)
+        self._pokerus.discard(individual_id)
+        for position in range(len(STATS)):
+            _discard(self._evs[position], keys.evs[position], individual_id)
+            _discard(self._remaining[position], keys.remaining[position], individual_id)
+
+    def all(self) -> set:
+        return set(self._keys)
+
+    def species(self, species_id) -> set:
+        return self._species.get(species_id, set())
+
+    def item(self, item_name) -> set:
+        return self._items.get(None if item_name is None else item_name.lower(), set())
+
+    def pokerus(self, present=True) -> set:
+        return set(self._pokerus) if present else self.all() - self._pokerus
+
+    def evs(self, stat, compare, value) -> set:
+        return _compare(self._evs[STATS.index(stat)], compare, value)
+
+    def remaining(self, stat, compare, value) -> set:
+        return _compare(self._remaining[STATS.index(stat)], compare, value)
+
+
+def _compare(buckets: dict[int, set], compare, value) -> set:
+    ids = set()
+    for key, bucket in buckets.items():
+        if compare(key, value):
+            ids |= bucket
+    return ids
+
+
+def parse(expression: str):
+    """
+    Parse a filter expression into a function taking a PokemonIndex and the
+    Tracker and returning the set of matching ids.
+    """
+    text = expression.strip()
+    match = _COMPARISON.match(text.lower())
+    if match:
+        field, name, symbol, value = match.groups()
+        stat = _stat(expression, name)
+        lookup = PokemonIndex.evs if field == 'evs' else PokemonIndex.remaining
+        return lambda index, tracker: lookup(index, stat, _OPERATORS[symbol], int(value))
+
+    key, _, value = text.partition('=')
+    key = key.strip().lower()
+    value = value.strip()
+    if key == 'species':
+        if not value:
+            raise InvalidFilter(expression, 'missing species')
+        species_id = pokedex.search(value).id
+        return lambda index, tracker: index.species(species_id)
+    if key == 'item':
+        if not value:
+            raise InvalidFilter(expression, 'missing item')
+        try:
+            if value.lower() == 'none':
+                item_name = None
+            else:
+                item_name = _ITEM_NAMES.get(value.lower()) or resolve_item_name(value)
+        except ValueError as e:
+            raise InvalidFilter(expression, str(e))
+        return lambda index, tracker: index.item(item_name)
+    if key == 'pokerus':
+        if value.lower() not in _YES + _NO:
+            raise InvalidFilter(expression, 'expected yes or no')
+        present = value.lower() in _YES
+        return lambda index, tracker: index.pokerus(present)
+    if key == 'location':
+        location = value.lower()
+        if location not in LOCATIONS:
+            raise InvalidFilter(expression, 'expected one of %s' % ', '.join(LOCATIONS))
+        return lambda index, tracker: set(tracker.get_location_ids(location))
+    if key == 'below_target':
+        stat = _stat(expression, value) if value else 'total'
+        return lambda index, tracker: index.remaining(stat, operator.gt, 0)
+    raise InvalidFilter(expression, 'unknown filter')
+
+
+def run(filters, index: PokemonIndex, tracker) -> list[int]:
+    """Return the ids matching every filter expression, in ascending order."""
+    lookups = [parse(expression) for expression in filters]
+    if not lookups:
+        return sorted(index.all())
+    candidates = sorted((lookup(index, tracker) for lookup in lookups), key=len)
+    ids = candidates[0]
+    for other in candidates[1:]:
+        if not ids:
+            break
+        ids = ids & other
+    return sorted(ids)
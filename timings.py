@@ -0,0 +1,129 @@
+"""
+Wall time spent per command and per phase of a command.
+
+Phases nest: the time of a phase excludes the phases started inside it, so
+the phases of a command add up to its latency. Latencies are kept per
+command for the last SAMPLES runs, from which the p50, p95 and max are
+reported.
+"""
+
+import time
+from collections import deque
+
+SAMPLES = 1000
+
+_QUANTILES = (0.5, 0.95)
+
+
+class _Phase(object):
+
+    __slots__ = ('timings', 'name', 'start', 'nested')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.timings._stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.timings._stack.pop()
+        if self.timings._stack:
+            self.timings._stack[-1].nested += elapsed
+        self.timings._add(self.name, elapsed - self.nested)
+
+
+class Timings(object):
+    """Phase and command timings for one process."""
+
+    def __init__(self):
+        self._stack: list[_Phase] = []
+        # Phase totals of the command running now, and of every command.
+        self.current: dict[str, float] = {}
+        self.phases: dict[str, float] = {}
+        self.phase_counts: dict[str, int] = {}
+        self.latencies: dict[str, deque] = {}
+        self.latency_sums: dict[str, float] = {}
+        self.latency_counts: dict[str, int] = {}
+        self.latency_max: dict[str, float] = {}
+
+    def phase(self, name) -> _Phase:
+        """A context manager timing one phase."""
+        return _Phase(self, name)
+
+    def _add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.phase_counts[name] = self.phase_counts.get(name, 0) + 1
+
+    def start_command(self):
+        self.current = {}
+
+    def finish_command(self, command, seconds):
+        """Record the latency of a command, returning the phases it spent its time in."""
+        samples = self.latencies.get(command)
+        if samples is None:
+            samples = self.latencies[command] = deque(maxlen=SAMPLES)
+        samples.append(seconds)
+        self.latency_sums[command] = self.latency_sums.get(command, 0.0) + seconds
+        self.latency_counts[command] = self.latency_counts.get(command, 0) + 1
+        self.latency_max[command] = max(self.latency_max.get(command, 0.0), seconds)
+        return self.current
+
+    def percentiles(self, command) -> tuple[float, float, float]:
+        """The p50, p95 and max latency of a command over its recent runs."""
+        ordered = sorted(self.latencies[command])
+        p50, p95 = (ordered[min(int(quantile * len(ordered)), len(ordered) - 1)] for quantile in _QUANTILES)
+        return p50, p95, self.latency_max[command]
+
+    def report(self) -> str:
+        lines = []
+        if self.latencies:
+            lines.append('%-16s %7s %10s %10s %10s' % ('Command', 'Count', 'p50 ms', 'p95 ms', 'max ms'))
+            for command in sorted(self.latencies):
+                p50, p95, most = self.percentiles(command)
+                lines.append('%-16s %7d %10.2f %10.2f %10.2f' % (command, self.latency_counts[command],
+                                                                p50 * 1000, p95 * 1000, most * 1000))
+        if self.phases:
+            if lines:
+                lines.append('')
+            lines.append('%-16s %7s %10s' % ('Phase', 'Count', 'total ms'))
+            for name, seconds in sorted(self.phases.items(), key=lambda item: -item[1]):
+                lines.append('%-16s %7d %10.2f' % (name, self.phase_counts[name], seconds * 1000))
+        if not lines:
+            return 'No commands timed yet'
+        return '\n'.join(lines)
+
+    def to_prometheus(self, timestamp=None) -> str:
+        """The timings in the Prometheus text exposition format."""
+        milliseconds = ' %d' % int((time.time() if timestamp is None else timestamp) * 1000)
+        lines = ['# HELP ev_command_seconds Command latency.', '# TYPE ev_command_seconds summary']
+        for command in sorted(self.latencies):
+            labels = 'command="%s"' % command
+            for quantile, value in zip(_QUANTILES, self.percentiles(command)):
+                lines.append('ev_command_seconds{%s,quantile="%s"} %.6f%s' % (labels, quantile, value, milliseconds))
+            lines.append('ev_command_seconds_sum{%s} %.6f%s' % (labels, self.latency_sums[command], milliseconds))
+            lines.append('ev_command_seconds_count{%s} %d%s' % (labels, self.latency_counts[command], milliseconds))
+        lines += ['# HELP ev_command_seconds_max Slowest run of a command.', '# TYPE ev_command_seconds_max gauge']
+        for command in sorted(self.latencies):
+            lines.append('ev_command_seconds_max{command="%s"} %.6f%s'
+                         % (command, self.latency_max[command], milliseconds))
+        lines += ['# HELP ev_phase_seconds_total Time spent in each phase of the commands.',
+                  '# TYPE ev_phase_seconds_total counter']
+        for name in sorted(self.phases):
+            lines.append('ev_phase_seconds_total{phase="%s"} %.6f%s' % (name, self.phases[name], milliseconds))
+        return '\n'.join(lines) + '\n'
+
+    def append_to(self, filename):
+        """Append the timings to a metrics file in the Prometheus text format."""
+        if not self.latencies:
+            return
+        with open(filename, 'a') as fp:
+            fp.write(self.to_prometheus())
+
+
+instance = Timings()
@@ -0,0 +1,1129 @@
+import contextlib
+import copy
+import json
+import os
+import re
+import sqlite3
+from collections.abc import MutableMapping
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import pokedex
+import query
+import timings
+from pokemon import Pokemon
+
+# How hard a save makes sure its writes reached the disk: 'full' syncs the
+# file and the directory entry of a replaced file, 'file' only syncs the
+# file, and 'off' leaves it to the operating system.
+FSYNC_POLICIES = ('full', 'file', 'off')
+
+
+def _sync(fp, fsync):
+    if fsync != 'off':
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def _sync_directory(filename, fsync):
+    if fsync != 'full' or not hasattr(os, 'O_DIRECTORY'):
+        return
+    descriptor = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def replace_file(filename, write, fsync):
+    """
+    Write a file with write(fp) to a temporary file next to it and rename it
+    into place, so that readers and crashes only ever see the old or the new
+    file, never a partly written one.
+    """
+    temporary = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        with open(temporary, 'w') as fp:
+            write(fp)
+            _sync(fp, fsync)
+        os.replace(temporary, filename)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    _sync_directory(filename, fsync)
+
+
+class FileLock(object):
+    """
+    An advisory lock on a '.lock' file next to a tracker file. Sessions hold
+    it while they check the tracker on disk and write their changes, so that
+    sessions sharing a tracker take turns. Reading needs no lock, as the
+    tracker file is only ever replaced whole.
+    """
+
+    SUFFIX = '.lock'
+
+    def __init__(self, filename):
+        self.filename = filename + FileLock.SUFFIX
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self.filename, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+        else:
+            self._fp.seek(0)
+            msvcrt.locking(self._fp.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+        else:
+            self._fp.seek(0)
+            msvcrt.locking(self._fp.fileno(), msvcrt.LK_UNLCK, 1)
+        self._fp.close()
+        self._fp = None
+
+
+class Journal(object):
+    """
+    An append-only log of changes made to a tracker, stored next to the
+    tracker snapshot. Each line is a JSON object that either stores a full
+    Pokemon record with its location ('put') or removes one ('del').
+    """
+
+    SUFFIX = '.journal'
+
+    def __init__(self, snapshot_filename):
+        self.filename = snapshot_filename + Journal.SUFFIX
+        self.length = 0
+        # Bytes of the journal read or written by this session.
+        self.size = 0
+
+    @staticmethod
+    def _entries(fp):
+        for line in fp:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return  # A partially written trailing entry, ignore it.
+
+    def replay(self, tracker):
+        try:
+            fp = open(self.filename, 'rb')
+        except IOError:
+            return  # No journal, the snapshot is up to date.
+        with fp:
+            for entry in Journal._entries(fp):
+                tracker.apply_journal_entry(entry)
+                self.length += 1
+            self.size = fp.tell()
+
+    def size_on_disk(self):
+        try:
+            return os.path.getsize(self.filename)
+        except OSError:
+            return 0
+
+    def entries_since(self, offset) -> list[dict]:
+        """The entries appended after offset bytes, by this or other sessions."""
+        try:
+            fp = open(self.filename, 'rb')
+        except IOError:
+            return []
+        with fp:
+            fp.seek(offset)
+            return list(Journal._entries(fp))
+
+    def append(self, entries, fsync='full'):
+        if not entries:
+            return
+        data = ''.join(json.dumps(entry) + '\n' for entry in entries).encode()
+        with open(self.filename, 'ab') as fp:
+            fp.write(data)
+            _sync(fp, fsync)
+        self.length += len(entries)
+        self.size += len(data)
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.length = 0
+        self.size = 0
+
+
+# Versions whose changed ids are kept in the tracker file, and the most ids
+# recorded for one version.
+_CHANGE_HISTORY = 64
+_MAX_CHANGE_IDS = 1000
+
+_STATS = ('hp', 'attack', 'defense', 'special_attack', 'special_defense', 'speed')
+_MAX_QUERY_PARAMETERS = 500
+
+
+class SqliteStore(object):
+    """
+    Tracker storage in a SQLite database next to the tracker file. Every
+    Pokemon is a row, so saving writes only the rows of the Pokemon that
+    changed, in one transaction. Like the tracker file, the database has a
+    version, kept as its user_version, and records the ids each recent
+    version changed in the changes table.
+    """
+
+    SUFFIX = '.sqlite3'
+
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS pokemon (
+            id INTEGER PRIMARY KEY,
+            species INTEGER NOT NULL,
+            form TEXT,
+            name TEXT,
+            item TEXT,
+            pokerus INTEGER NOT NULL DEFAULT 0,
+            created INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS evs (
+            pokemon_id INTEGER PRIMARY KEY,
+            hp INTEGER NOT NULL,
+            attack INTEGER NOT NULL,
+            defense INTEGER NOT NULL,
+            special_attack INTEGER NOT NULL,
+            special_defense INTEGER NOT NULL,
+            speed INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS targets (
+            pokemon_id INTEGER PRIMARY KEY,
+            hp INTEGER NOT NULL,
+            attack INTEGER NOT NULL,
+            defense INTEGER NOT NULL,
+            special_attack INTEGER NOT NULL,
+            special_defense INTEGER NOT NULL,
+            speed INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS membership (
+            pokemon_id INTEGER NOT NULL,
+            location TEXT NOT NULL,
+            PRIMARY KEY (pokemon_id, location)
+        );
+        CREATE INDEX IF NOT EXISTS membership_location ON membership (location, pokemon_id);
+        CREATE TABLE IF NOT EXISTS changes (
+            version INTEGER NOT NULL,
+            pokemon_id INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS changes_version ON changes (version);
+    '''
+
+    _SELECT_POKEMON = '''SELECT p.id, p.species, p.form, p.name, p.item, p.pokerus,
+                         e.hp, e.attack, e.defense, e.special_attack, e.special_defense, e.speed,
+                         t.hp, t.attack, t.defense, t.special_attack, t.special_defense, t.speed,
+                         p.created
+                         FROM pokemon AS p
+                         JOIN evs AS e ON e.pokemon_id = p.id
+                         LEFT JOIN targets AS t ON t.pokemon_id = p.id'''
+
+    # SQLite's own durability settings for each fsync policy.
+    _SYNCHRONOUS = {'full': 'FULL', 'file': 'NORMAL', 'off': 'OFF'}
+
+    def __init__(self, tracker_filename, fsync='full'):
+        self.filename = tracker_filename + SqliteStore.SUFFIX
+        self.fsync = fsync
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.execute('PRAGMA synchronous = %s' % SqliteStore._SYNCHRONOUS[self.fsync])
+            self._connection.executescript(SqliteStore._SCHEMA)
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(pokemon)')]
+            if 'created' not in columns:
+                # Databases made before Pokemon recorded when they were tracked.
+                self._connection.execute('ALTER TABLE pokemon ADD COLUMN created INTEGER')
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Hold the database's write lock for the block, then commit, or roll back if it raised."""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def load(self, tracker):
+        """
+        Read the ids and locations of the tracked Pokemon. The Pokemon
+        themselves are fetched from the database when first used.
+        """
+        is_new = not os.path.exists(self.filename)
+        connection = self._connect()
+        if is_new and os.path.exists(tracker.filename):
+            self.migrate(Tracker.from_json(tracker.filename))
+        tracker.version = self.version()
+        for (individual_id,) in connection.execute('SELECT id FROM pokemon ORDER BY id'):
+            tracker._pokemon.add_stored(individual_id)
+        tracker._team = self.location('team')
+        tracker._archive = self.location('archive')
+
+    def version(self) -> int:
+        return self._connect().execute('PRAGMA user_version').fetchone()[0]
+
+    def changed_since(self, version):
+        """
+        The ids of the Pokemon saved by versions after version, or None if
+        they are no longer recorded.
+        """
+        connection = self._connect()
+        (oldest,) = connection.execute('SELECT MIN(version) FROM changes').fetchone()
+        if oldest is None or oldest > version + 1:
+            return None
+        ids = {individual_id for (individual_id,) in
+               connection.execute('SELECT pokemon_id FROM changes WHERE version > ?', (version,))}
+        # Large changes are recorded as unknown, which conflicts with any other change.
+        return None if None in ids else ids
+
+    def record_changes(self, version, ids) -> int:
+        """Record the ids saved by the version after version, returning the new version."""
+        version += 1
+        connection = self._connect()
+        connection.executemany('INSERT INTO changes VALUES (?, ?)',
+                               [(version, individual_id) for individual_id in
+                                ([None] if len(ids) > _MAX_CHANGE_IDS else sorted(ids))])
+        connection.execute('DELETE FROM changes WHERE version <= ?', (version - _CHANGE_HISTORY,))
+        connection.execute('PRAGMA user_version = %d' % version)
+        return version
+
+    def refresh(self, tracker, ids=None):
+        """
+        Read again the ids and locations of the given Pokemon, or of all of
+        them, after other sessions saved them. Their rows are fetched again
+        when next used.
+        """
+        stored = self.stored_ids()
+        if ids is None:
+            ids = set(stored) | set(tracker._pokemon)
+        team, archive = self.location('team'), self.location('archive')
+        for individual_id in ids:
+            if individual_id in stored:
+                tracker._pokemon.add_stored(individual_id)
+            else:
+                tracker._pokemon._entries.pop(individual_id, None)
+            for mine, theirs in ((tracker._team, team), (tracker._archive, archive)):
+                if individual_id in theirs:
+                    mine.setdefault(individual_id)
+                else:
+                    mine.pop(individual_id, None)
+
+    def stored_ids(self) -> set[int]:
+        """The ids of every stored Pokemon."""
+        return {individual_id for (individual_id,) in self._connect().execute('SELECT id FROM pokemon')}
+
+    def location(self, location) -> dict:
+        """The ids of the Pokemon in a location, read through its index."""
+        rows = self._connect().execute('SELECT pokemon_id FROM membership WHERE location = ? ORDER BY pokemon_id',
+                                       (location,))
+        return {individual_id: None for (individual_id,) in rows}
+
+    def fetch(self, individual_ids) -> list[dict]:
+        """Read Pokemon by id as records in the tracker file format."""
+        individual_ids = list(individual_ids)
+        records = []
+        for start in range(0, len(individual_ids), _MAX_QUERY_PARAMETERS):
+            chunk = individual_ids[start:start + _MAX_QUERY_PARAMETERS]
+            rows = self._connect().execute(
+                '%s WHERE p.id IN (%s) ORDER BY p.id' % (SqliteStore._SELECT_POKEMON, ', '.join('?' * len(chunk))),
+                chunk)
+            records.extend(SqliteStore._record(row) for row in rows)
+        return records
+
+    @staticmethod
+    def _record(row) -> dict:
+        record = {'species': row[1], 'name': row[3], 'pokerus': bool(row[5]), 'item': row[4],
+                  'evs': dict(zip(_STATS, row[6:12])), 'id': row[0]}
+        if row[12] is not None:
+            record['target_evs'] = dict(zip(_STATS, row[12:18]))
+        if row[2] is not None:
+            record['form'] = row[2]
+        if row[18] is not None:
+            record['created'] = row[18]
+        return record
+
+    def save(self, records, locations, deleted):
+        """
+        Write changed Pokemon records, the locations of Pokemon that moved
+        and the removal of released Pokemon. Call inside transaction().
+        """
+        connection = self._connect()
+        if deleted:
+            deleted = [(individual_id,) for individual_id in deleted]
+            connection.executemany('DELETE FROM pokemon WHERE id = ?', deleted)
+            for table in ('evs', 'targets', 'membership'):
+                connection.executemany('DELETE FROM %s WHERE pokemon_id = ?' % table, deleted)
+        if records:
+            connection.executemany(
+                'INSERT OR REPLACE INTO pokemon (id, species, form, name, item, pokerus, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(record['id'], record['species'], record.get('form'), record['name'], record['item'],
+                  bool(record['pokerus']), record.get('created')) for record in records])
+            connection.executemany(
+                'INSERT OR REPLACE INTO evs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(record['id'],) + tuple(record['evs'][stat] for stat in _STATS) for record in records])
+            connection.executemany(
+                'INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(record['id'],) + tuple(record['target_evs'][stat] for stat in _STATS)
+                 for record in records if 'target_evs' in record])
+        if locations:
+            connection.executemany('DELETE FROM membership WHERE pokemon_id = ?',
+                                   [(individual_id,) for individual_id in locations])
+            connection.executemany('INSERT INTO membership VALUES (?, ?)',
+                                   [(individual_id, location)
+                                    for individual_id, names in locations.items() for location in names])
+
+    def migrate(self, source):
+        """Import every Pokemon of a JSON tracker into the database."""
+        source._load()
+        locations = {individual_id: SqliteStore._locations(source, individual_id) for individual_id in source._pokemon}
+        with self.transaction():
+            self.save(list(source._pokemon.records()), locations, ())
+
+    @staticmethod
+    def _locations(tracker, individual_id) -> list[str]:
+        return ([] if individual_id not in tracker._team else ['team']) + \
+            ([] if individual_id not in tracker._archive else ['archive'])
+
+
+def _prefetch_species(specs):
+    """
+    Resolve the species of every Pokemon record up front with bulk queries, so
+    that building the Pokemon only hits the species cache.
+    """
+    species_ids = set()
+    names = set()
+    for spec in specs:
+        species = spec['species']
+        if isinstance(species, str) and not species.isdigit():
+            names.add(species)
+        else:
+            species_ids.add(int(species))
+    pokedex.fetch_many(species_ids)
+    pokedex.fetch_many_by_name(names)
+
+
+_READ_SIZE = 1 << 16
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_RECORD_SEPARATOR = '}, {'
+
+
+class _TrackerFileReader(object):
+    """
+    Incremental reader for the tracker file. The file is read in fixed size
+    chunks and the 'pokemon' array is decoded one record at a time, so the
+    whole file is never held in memory as text.
+    """
+
+    def __init__(self, fp, read_size=_READ_SIZE):
+        self._fp = fp
+        self._read_size = read_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._fp.read(self._read_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # Drop everything already consumed before appending.
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of tracker file')
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected %r at offset %d of tracker file' % (char, self._pos))
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A value ending with the buffer may continue in the next chunk.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _records(self):
+        """Yield the records of the 'pokemon' array, starting after its '['."""
+        while True:
+            # Decode all the complete records in the buffer with one call where
+            # possible. This is faster than one call per record and shares the
+            # key strings between records. A separator found inside a string
+            # leaves the batch unterminated, so it fails to decode instead.
+            boundary = self._buffer.rfind(_RECORD_SEPARATOR, self._pos)
+            if boundary != -1:
+                try:
+                    batch = json.loads('[' + self._buffer[self._pos:boundary + 1] + ']')
+                except ValueError:
+                    batch = None
+                if batch is not None:
+                    self._pos = boundary + 2
+                    yield from batch
+                    continue
+            yield self._value()
+            if self._peek() != ',':
+                return
+            self._pos += 1
+
+    def __iter__(self):
+        """Yield (key, value) pairs, with one ('pokemon', record) pair per record."""
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'pokemon' and self._peek() == '[':
+                self._pos += 1
+                if self._peek() != ']':
+                    for record in self._records():
+                        yield key, record
+                self._expect(']')
+            else:
+                yield key, self._value()
+            if self._peek() != ',':
+                break
+            self._pos += 1
+        self._expect('}')
+
+
+def _write_tracker_file(fp, team, archive, records, version=0, changes=()):
+    """
+    Write the tracker file one record at a time. The output is byte for byte
+    what json.dump produces for the equivalent dict.
+    """
+    fp.write('{"version": %d, "changes": %s, "team": %s, "archive": %s, "pokemon": ['
+             % (version, json.dumps(list(changes)), json.dumps(team), json.dumps(archive)))
+    separator = ''
+    for record in records:
+        fp.write(separator)
+        fp.write(json.dumps(record))
+        separator = ', '
+    fp.write(']}')
+
+
+def _read_header(filename):
+    """
+    Read the version and change history of a tracker file without reading
+    its Pokemon. A missing file is version 0, as are files written before
+    versions were kept.
+    """
+    version, changes = 0, []
+    try:
+        fp = open(filename, 'r')
+    except IOError:
+        return version, changes
+    with fp:
+        for key, value in _TrackerFileReader(fp):
+            if key == 'version':
+                version = value
+            elif key == 'changes':
+                changes = value
+            else:
+                break
+    return version, changes
+
+
+# Marks a Pokemon that was not tracked at a checkpoint.
+_ABSENT = object()
+
+
+class _TrackedPokemon(MutableMapping):
+    """
+    The tracked Pokemon by id. Pokemon read from a file are kept as their raw
+    records and only built into Pokemon objects when first accessed, so
+    looking up one Pokemon does not build every other one. Pokemon kept in a
+    SqliteStore are not even read until first accessed; their entry is None.
+    """
+
+    def __init__(self, store: SqliteStore = None):
+        self._entries: dict[int, Pokemon | dict | None] = {}
+        self._store = store
+        # Entries as they were at checkpoint(), of the ones used since.
+        self._saved: dict | None = None
+
+    def _save(self, individual_id):
+        if individual_id not in self._saved:
+            entry = self._entries.get(individual_id, _ABSENT)
+            if isinstance(entry, Pokemon):
+                entry = entry.copy()
+            elif isinstance(entry, dict):
+                # Pokemon.from_dict changes the record it builds from.
+                entry = copy.deepcopy(entry)
+            self._saved[individual_id] = entry
+
+    def checkpoint(self):
+        self._saved = {}
+
+    def restore(self) -> list[int]:
+        """Put back the entries saved since checkpoint(), returning their ids."""
+        for individual_id, entry in self._saved.items():
+            if entry is _ABSENT:
+                self._entries.pop(individual_id, None)
+            else:
+                self._entries[individual_id] = entry
+        restored = list(self._saved)
+        self._saved = None
+        return restored
+
+    def release(self):
+        self._saved = None
+
+    def __getitem__(self, individual_id) -> Pokemon:
+        if self._saved is not None:
+            self._save(individual_id)
+        entry = self._entries[individual_id]
+        if entry is None:
+            entry = self._store.fetch([individual_id])[0]
+        if isinstance(entry, dict):
+            entry = self._entries[individual_id] = Pokemon.from_dict(entry)
+        return entry
+
+    def __setitem__(self, individual_id, pokemon: Pokemon):
+        if self._saved is not None:
+            self._save(individual_id)
+        self._entries[individual_id] = pokemon
+
+    def __delitem__(self, individual_id):
+        if self._saved is not None:
+            self._save(individual_id)
+        del self._entries[individual_id]
+
+    def __contains__(self, individual_id):
+        return individual_id in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add_record(self, record: dict):
+        self._entries[int(record['id'])] = record
+
+    def add_stored(self, individual_id):
+        self._entries[individual_id] = None
+
+    def is_built(self, individual_id):
+        return isinstance(self._entries.get(individual_id), Pokemon)
+
+    def _fetch_stored(self):
+        stored = [individual_id for individual_id, entry in self._entries.items() if entry is None]
+        if stored:
+            for record in self._store.fetch(stored):
+                self._entries[record['id']] = record
+
+    def records(self):
+        """
+        Yield every Pokemon as a record in the tracker file format. Records
+        that were never built are passed through unchanged.
+        """
+        self._fetch_stored()
+        for entry in self._entries.values():
+            yield entry if isinstance(entry, dict) and 'form' not in entry else self._build(entry).to_dict()
+
+    def _build(self, entry) -> Pokemon:
+        if isinstance(entry, dict):
+            individual_id = int(entry['id'])
+            entry = self._entries[individual_id] = Pokemon.from_dict(entry)
+        return entry
+
+    def build_all(self):
+        with timings.instance.phase('tracker_load'):
+            self._fetch_stored()
+            records = [entry for entry in self._entries.values() if isinstance(entry, dict)]
+            if records:
+                _prefetch_species(records)
+                for record in records:
+                    self._build(record)
+
+    def values(self):
+        self.build_all()
+        return self._entries.values()
+
+    def items(self):
+        self.build_all()
+        return self._entries.items()
+
+
+class Tracker(object):
+
+    @classmethod
+    def from_json(cls, filename, fsync='full'):
+        """
+        Create a tracker for a tracker file. The file is only read when the
+        tracked Pokemon, the team or the archive are first used.
+        """
+        tracker = cls()
+        tracker.filename = filename
+        tracker.fsync = fsync
+        tracker.journal = Journal(filename)
+        tracker._loaded = False
+        return tracker
+
+    @classmethod
+    def from_sqlite(cls, filename, fsync='full'):
+        """
+        Create a tracker kept in a SQLite database next to the tracker file.
+        An existing tracker file is imported when the database is created.
+        """
+        tracker = cls()
+        tracker.filename = filename
+        tracker.fsync = fsync
+        tracker.store = SqliteStore(filename, fsync)
+        tracker._pokemon = _TrackedPokemon(tracker.store)
+        tracker._loaded = False
+        return tracker
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        with timings.instance.phase('tracker_load'):
+            self._read()
+
+    def _read(self):
+        if self.store is not None:
+            self.store.load(self)
+            self._index_box()
+            return
+        try:
+            fp = open(self.filename, 'r')
+        except IOError:
+            fp = None  # Ignore missing tracking file.
+        if fp is not None:
+            with fp:
+                for key, value in _TrackerFileReader(fp):
+                    if key == 'pokemon':
+                        self._pokemon.add_record(value)
+                    elif key == 'team':
+                        self._team = dict.fromkeys(value)
+                    elif key == 'archive':
+                        self._archive = dict.fromkeys(value)
+                    elif key == 'version':
+                        self.version = value
+                    elif key == 'changes':
+                        self._history = value
+
+        self.journal.replay(self)
+        self._index_box()
+        self._journaled = set(self._changed)
+        self._changed.clear()
+
+    def to_json(self, filename=None):
+        """
+        Write the tracker file. Saving to the tracker's own file first merges
+        in what other sessions saved since this one loaded it, and raises
+        TrackerConflict instead if they changed the same Pokemon.
+        """
+        self._load()
+        if filename is not None and filename != self.filename:
+            replace_file(filename, lambda fp: _write_tracker_file(
+                fp, list(self._team), list(self._archive), self._pokemon.records(), self.version), self.fsync)
+            return
+        with FileLock(self.filename):
+            self._merge_saved()
+            changed = self._changed | self._journaled
+            # Large changes are recorded as unknown, which conflicts with any other change.
+            history = self._history + [[self.version + 1, None if len(changed) > _MAX_CHANGE_IDS else sorted(changed)]]
+            history = history[-_CHANGE_HISTORY:]
+            replace_file(self.filename, lambda fp: _write_tracker_file(
+                fp, list(self._team), list(self._archive), self._pokemon.records(), self.version + 1, history),
+                self.fsync)
+            self.version += 1
+            self._history = history
+            if self.journal is not None:
+                # The snapshot now includes every journaled change.
+                self.journal.clear()
+            self._changed.clear()
+            self._journaled.clear()
+
+    def _saved_elsewhere(self):
+        """
+        Return the version and change history on disk, and the ids of the
+        Pokemon other sessions saved since this tracker was loaded or last
+        saved: an empty set if there are none, or None if they are not known.
+        Call with the file lock held.
+        """
+        version, history = _read_header(self.filename)
+        journal_size = 0 if self.journal is None else self.journal.size_on_disk()
+        if version == self.version and (self.journal is None or journal_size == self.journal.size):
+            return version, history, set()
+        ids = set()
+        if version != self.version:
+            saved = {entry_version: entry_ids for entry_version, entry_ids in history}
+            for missed in range(self.version + 1, version + 1):
+                if saved.get(missed) is None:
+                    return version, history, None
+                ids.update(saved[missed])
+        if self.journal is not None:
+            # A new snapshot starts a new journal.
+            offset = self.journal.size if version == self.version else 0
+            for entry in self.journal.entries_since(offset):
+                ids.add(int(entry['pokemon']['id']) if entry['op'] == 'put' else entry['id'])
+        return version, history, ids
+
+    def _merge_saved(self):
+        """
+        Bring in the Pokemon other sessions saved, keeping the changes this
+        session has not saved yet. Call with the file lock held.
+        """
+        version, history, ids = self._saved_elsewhere()
+        if ids is not None and not ids:
+            return
+        conflicts = self._changed if ids is None else self._changed & ids
+        if conflicts:
+            raise TrackerConflict(conflicts)
+        saved = Tracker.from_json(self.filename, self.fsync)
+        saved._load()
+        for individual_id in self._changed:
+            if individual_id in self._pokemon:
+                saved._pokemon._entries[individual_id] = self._pokemon._entries[individual_id]
+            else:
+                saved._pokemon._entries.pop(individual_id, None)
+            for mine, theirs in ((self._team, saved._team), (self._archive, saved._archive)):
+                if individual_id in mine:
+                    theirs.setdefault(individual_id)
+                else:
+                    theirs.pop(individual_id, None)
+        # The journal on disk holds what every session journaled since the last snapshot.
+        self._journaled = saved._journaled
+        self._pokemon, self._team, self._archive = saved._pokemon, saved._team, saved._archive
+        self.version, self._history, self.journal = version, history, saved.journal
+        self._index_box()
+        self._index = None
+
+    def write_journal(self):
+        """Append the changes made since the last save to the journal."""
+        self._load()
+        with FileLock(self.filename):
+            self._merge_saved()
+            self._append_journal()
+
+    def _append_journal(self):
+        entries = []
+        for individual_id in self._changed:
+            if individual_id in self._pokemon:
+                entries.append({
+                    'op': 'put',
+                    'pokemon': self._pokemon[individual_id].to_dict(),
+                    'team': self.on_team(individual_id),
+                    'archive': self.in_archive(individual_id),
+                })
+            else:
+                entries.append({'op': 'del', 'id': individual_id})
+        self.journal.append(entries, self.fsync)
+        self._journaled |= self._changed
+        self._changed.clear()
+
+    def write_database(self):
+        """
+        Write the Pokemon changed since the last save to the database. The
+        Pokemon other sessions saved since are read again first, and
+        TrackerConflict is raised instead if they changed the same Pokemon.
+        """
+        self._load()
+        with self.store.transaction():
+            self._merge_stored()
+            records = []
+            locations = {}
+            deleted = []
+            for individual_id in self._changed:
+                if individual_id not in self._pokemon:
+                    deleted.append(individual_id)
+                    continue
+                # Pokemon that were never built can only have changed location.
+                if self._pokemon.is_built(individual_id):
+                    records.append(self._pokemon[individual_id].to_dict())
+                locations[individual_id] = SqliteStore._locations(self, individual_id)
+            self.store.save(records, locations, deleted)
+            version = self.store.record_changes(self.version, self._changed)
+        self.version = version
+        self._changed.clear()
+
+    def _merge_stored(self):
+        """
+        Bring in the Pokemon other sessions saved to the database, keeping
+        the changes this session has not saved yet. Call inside a transaction.
+        """
+        version = self.store.version()
+        if version == self.version:
+            return
+        ids = self.store.changed_since(self.version)
+        conflicts = self._changed if ids is None else self._changed & ids
+        if conflicts:
+            raise TrackerConflict(conflicts)
+        self.store.refresh(self, ids)
+        self._index_box()
+        self._index = None
+        self.version = version
+
+    def apply_journal_entry(self, entry):
+        if entry['op'] == 'put':
+            self._pokemon.add_record(entry['pokemon'])
+            individual_id = int(entry['pokemon']['id'])
+            self._set_location(individual_id, self._team, entry['team'])
+            self._set_location(individual_id, self._archive, entry['archive'])
+        elif entry['op'] == 'del' and entry['id'] in self._pokemon:
+            self._forget(entry['id'])
+
+    def __init__(self):
+        self._pokemon = _TrackedPokemon()
+        # Location index: ordered sets of ids (dicts with None values) in the
+        # order the Pokemon arrived there. The box holds every tracked Pokemon
+        # that is neither on the team nor in the archive.
+        self._team: dict[int, None] = {}
+        self._archive: dict[int, None] = {}
+        self._box: dict[int, None] = {}
+        self._changed = set()
+        # Ids journaled since the last snapshot, recorded with the next one.
+        self._journaled = set()
+        # Version of the tracker file this tracker was loaded from or last
+        # saved, and the ids changed by recent versions.
+        self.version = 0
+        self._history = []
+        self.fsync = 'full'
+        # Team and archive membership at checkpoint(), of the Pokemon moved since.
+        self._moved: dict[int, tuple[bool, bool]] | None = None
+        self._saved_counter = None
+        # Secondary indexes for query(), built by the first query.
+        self._index: query.PokemonIndex | None = None
+        self._loaded = True
+        self.counter = 1
+        self.filename = None
+        self.journal = None
+        self.store = None
+
+    @property
+    def pokemon(self) -> _TrackedPokemon:
+        self._load()
+        return self._pokemon
+
+    def mark_changed(self, pokemon: Pokemon):
+        """Record that a tracked Pokemon was modified and needs saving."""
+        self._changed.add(pokemon.get_individual_id())
+        if self._index is not None:
+            self._index.update(pokemon)
+
+    def query(self, *filters) -> list[Pokemon]:
+        """
+        Return the tracked Pokemon matching every filter expression, ordered
+        by id. See the query module for the filter syntax.
+        """
+        self._load()
+        if self._index is None:
+            self._index = query.PokemonIndex(self._pokemon.values())
+        return [self._pokemon[individual_id] for individual_id in query.run(filters, self._index, self)]
+
+    def checkpoint(self):
+        """
+        Remember the tracker as it is now, so that rollback() can undo what
+        is changed after this without reloading it. Only the Pokemon and
+        locations used after the checkpoint are copied.
+        """
+        self._load()
+        self._pokemon.checkpoint()
+        self._moved = {}
+        self._saved_counter = self.counter
+
+    def rollback(self):
+        """Undo every change made since checkpoint(), keeping the unsaved changes made before it."""
+        for individual_id, (on_team, in_archive) in self._moved.items():
+            for location, present in ((self._team, on_team), (self._archive, in_archive)):
+                if present:
+                    location.setdefault(individual_id)
+                else:
+                    location.pop(individual_id, None)
+        restored = self._pokemon.restore()
+        for individual_id in list(self._moved) + restored:
+            self._update_box(individual_id)
+            # Saving the restored Pokemon again is harmless, missing a change is not.
+            self._changed.add(individual_id)
+        self.counter = self._saved_counter
+        self._moved = None
+        self._index = None
+
+    def release_checkpoint(self):
+        """Stop remembering changes for rollback()."""
+        self._pokemon.release()
+        self._moved = None
+
+    def has_changes(self):
+        if not self._loaded:
+            return self.journal is not None and os.path.exists(self.journal.filename)
+        return len(self._changed) > 0 or (self.journal is not None and self.journal.length > 0)
+
+    def _set_location(self, individual_id, location: dict, present: bool):
+        if self._moved is not None and individual_id not in self._moved:
+            self._moved[individual_id] = (individual_id in self._team, individual_id in self._archive)
+        if present and individual_id not in location:
+            location[individual_id] = None
+        elif not present and individual_id in location:
+            del location[individual_id]
+        else:
+            return
+        self._changed.add(individual_id)
+        self._update_box(individual_id)
+
+    def _update_box(self, individual_id):
+        if individual_id in self._pokemon and individual_id not in self._team and individual_id not in self._archive:
+            self._box.setdefault(individual_id)
+        else:
+            self._box.pop(individual_id, None)
+
+    def _index_box(self):
+        self._box = {individual_id: None for individual_id in self._pokemon
+                     if individual_id not in self._team and individual_id not in self._archive}
+
+    def add_to_team(self, individual_id):
+        self._load()
+        self._set_location(individual_id, self._team, True)
+
+    def on_team(self, individual_id):
+        self._load()
+        return individual_id in self._team
+
+    def remove_from_team(self, individual_id):
+        self._load()
+        self._set_location(individual_id, self._team, False)
+
+    def get_team(self):
+        self._load()
+        return self._team
+
+    def add_to_archive(self, individual_id):
+        self._load()
+        self._set_location(individual_id, self._archive, True)
+
+    def in_archive(self, individual_id):
+        self._load()
+        return individual_id in self._archive
+
+    def remove_from_archive(self, individual_id):
+        self._load()
+        self._set_location(individual_id, self._archive, False)
+
+    def get_archive(self):
+        self._load()
+        return self._archive
+
+    def get_box(self):
+        self._load()
+        return self._box
+
+    def get_location_ids(self, location):
+        """The ids in a location index, by location name: team, box or archive."""
+        self._load()
+        return {'team': self._team, 'box': self._box, 'archive': self._archive}[location]
+
+    def get_location(self, individual_id):
+        self._load()
+        if individual_id in self._team:
+            return 'Team'
+        elif individual_id in self._archive:
+            return 'Archive'
+        return 'Box'
+
+    def get_pokemon(self, individual_id):
+        if individual_id not in self.pokemon:
+            raise NoTrackedPokemon(individual_id)
+        return self.pokemon[individual_id]
+
+    def unique_id(self):
+        while self.counter in self.pokemon:
+            self.counter += 1
+        return self.counter
+
+    def track(self, pokemon: Pokemon):
+        self.pokemon[pokemon.get_individual_id()] = pokemon
+        self._update_box(pokemon.get_individual_id())
+        self.mark_changed(pokemon)
+
+    def _forget(self, individual_id):
+        del self._pokemon[individual_id]
+        self._set_location(individual_id, self._team, False)
+        self._set_location(individual_id, self._archive, False)
+        self._box.pop(individual_id, None)
+        self._changed.add(individual_id)
+        if self._index is not None:
+            self._index.remove(individual_id)
+
+    def untrack(self, pokemon: Pokemon):
+        self._load()
+        self._forget(pokemon.get_individual_id())
+        pokemon.delete()
+
+    def __str__(self):
+        if len(self.pokemon):
+            return '\n'.join([pokemon.listing(self._team) for pokemon in self.pokemon.values()])
+        else:
+            return 'No tracked Pokemon'
+
+
+class TrackerConflict(Exception):
+    """
+    Raised when saving a tracker that another session saved changes to the
+    same Pokemon since this session loaded it.
+    """
+
+    def __init__(self, ids):
+        super(TrackerConflict, self).__init__(
+            'Pokemon %s changed in another session' % ', '.join(str(i) for i in sorted(ids)))
+        self.ids = ids
+
+
+class NoActivePokemon(Exception):
+    """
+    Raised when an operation that assumes the existence of an active Pokemon
+    is carried out and the team is empty.
+    """
+    pass
+
+
+class NoTrackedPokemon(Exception):
+    """
+    Raised when an id is requested from a Tracker but the Tracker does not
+    have a Pokemon with the provided id.
+    """
+
+    def __init__(self, individual_id):
+        super(NoTrackedPokemon, self).__init__()
+        self.id = individual_id